@@ -0,0 +1,108 @@
+"""
+Compare the overhead of the metrics middleware with the former `BaseHTTPMiddleware`
+implementation. The app is called directly, without a server and a client, so that the
+middleware is the only thing that differs.
+
+    PYTHONPATH=src python benchmarks/metrics_middleware.py
+"""
+
+import asyncio
+import time
+import uuid
+
+from fastapi import FastAPI, Request, Response
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from app.core.config import settings
+from app.middlewares.metrics import (
+    APP_HTTP_REQUEST_COUNT,
+    APP_HTTP_REQUEST_DURATION_SECONDS,
+    MetricsMiddleware,
+    base_http_request_metric_labels,
+)
+
+REQUEST_COUNT = 10_000
+ROUNDS = 5
+
+
+class BaseHTTPMetricsMiddleware(BaseHTTPMiddleware):
+    """The former implementation."""
+
+    async def dispatch(self, request: Request, call_next) -> Response:
+        start_at = time.perf_counter()
+        response = await call_next(request)
+        labels = base_http_request_metric_labels(
+            app=settings.APP_NAME,
+            path=request.url.path,
+            method=request.method,
+            status_code=response.status_code,
+        )
+        APP_HTTP_REQUEST_DURATION_SECONDS.labels(*labels).observe(time.perf_counter() - start_at)
+        APP_HTTP_REQUEST_COUNT.labels(*labels).inc()
+        return response
+
+
+def create_app(middleware_class: type | None) -> FastAPI:
+    app = FastAPI()
+    if middleware_class:
+        app.add_middleware(middleware_class)
+
+    @app.get('/notes/{id}')
+    async def read_note(id: uuid.UUID):
+        return {'id': id}
+
+    return app
+
+
+async def call(app: FastAPI, path: str):
+    scope = {
+        'type': 'http',
+        # 2.4 servers don't make responses listen for a client disconnect.
+        'asgi': {'version': '3.0', 'spec_version': '2.4'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'root_path': '',
+        'query_string': b'',
+        'headers': [],
+        'client': ('127.0.0.1', 50000),
+        'server': ('127.0.0.1', 8000),
+    }
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def measure(app: FastAPI) -> float:
+    """The best time of a request of several rounds, seconds."""
+    paths = [f'/notes/{uuid.uuid4()}' for _ in range(REQUEST_COUNT)]
+    durations = []
+    for _ in range(ROUNDS):
+        start_at = time.perf_counter()
+        for path in paths:
+            await call(app, path)
+        durations.append((time.perf_counter() - start_at) / REQUEST_COUNT)
+    return min(durations)
+
+
+async def main():
+    baseline = await measure(create_app(None))
+    print(f'{"no middleware":<20} {baseline * 1e6:8.1f} us/request')
+    for name, middleware_class in (
+        ('BaseHTTPMiddleware', BaseHTTPMetricsMiddleware),
+        ('pure ASGI', MetricsMiddleware),
+    ):
+        duration = await measure(create_app(middleware_class))
+        overhead = duration - baseline
+        print(f'{name:<20} {duration * 1e6:8.1f} us/request, overhead {overhead * 1e6:6.1f} us')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
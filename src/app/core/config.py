@@ -21,10 +21,30 @@ class LoggerLevel(str, Enum):
     CRITICAL = 'CRITICAL'
 
 
+class EncoderExecutor(str, Enum):
+    THREAD = 'thread'
+    PROCESS = 'process'
+    HOST = 'host'
+
+
+class EncoderBackend(str, Enum):
+    TORCH = 'torch'
+    ONNX = 'onnx'
+    OPENVINO = 'openvino'
+
+
+class EmbeddingMode(str, Enum):
+    SYNC = 'sync'
+    ASYNC = 'async'
+
+
 class Settings(BaseSettings):
     APP_NAME: str = 'notes'
     API_V1_STR: str = '/api/v1'
     ISOLATION_LEVEL: str = 'REPEATABLE READ'
+    # Of the read-only routes. A snapshot per statement is enough for them and they never fail
+    # on a serialization failure.
+    READ_ONLY_ISOLATION_LEVEL: str = 'READ COMMITTED'
 
     UVICORN_HOST: str = '0.0.0.0'
     UVICORN_PORT: int = 8000
@@ -43,9 +63,65 @@ class Settings(BaseSettings):
     DB_ENGINE_POOL_SIZE: int = 20
     DB_ENGINE_POOL_RECYCLE: int = 60 * 60  # 1 hour
     DB_ENGINE_POOL_PRE_PING: bool = True
+    # Write transactions are run again when they fail on a serialization failure
+    # or a deadlock, after a random delay of up to the backoff doubled on every attempt.
+    DB_TRANSACTION_MAX_ATTEMPTS: int = 3
+    DB_TRANSACTION_RETRY_BACKOFF: float = 0.05  # seconds
+    # Applied to every semantic search transaction. More candidates means better recall
+    # and slower search. Iterative scans keep filtered searches (by owner etc.) from
+    # returning less rows than requested.
+    DB_HNSW_EF_SEARCH: int = 40
+    DB_HNSW_ITERATIVE_SCAN: Literal['off', 'strict_order', 'relaxed_order'] = 'strict_order'
+    # Iterative scans stop after visiting this many index tuples. One index serves all owners,
+    # so a search of an owner holding a small share of the notes visits about the chunks it
+    # needs divided by that share. A lower limit returns a short page though more notes match.
+    DB_HNSW_MAX_SCAN_TUPLES: int = 20_000
 
     JWT_SECRET: str = secrets.token_urlsafe(32)
 
+    # Threads share one model, every process loads its own copy. With `host` the server runs
+    # the only copy in the encoder host process and app workers send jobs to it over a Unix
+    # socket, the rest of the ENCODER_* settings apply to both.
+    ENCODER_EXECUTOR: EncoderExecutor = EncoderExecutor.THREAD
+    ENCODER_HOST_SOCKET: str = '/tmp/encoder_host.sock'
+    ENCODER_HOST_START_TIMEOUT: float = 120.0  # seconds
+    # ONNX Runtime and OpenVINO are lighter than PyTorch on CPU. They need the `onnx`
+    # or `openvino` extra of the project installed.
+    ENCODER_BACKEND: EncoderBackend = EncoderBackend.TORCH
+    # A model file of the backend from the model repository, None means the full precision one.
+    # Int8 quantized models: `onnx/model_qint8_avx512_vnni.onnx`, `onnx/model_quint8_avx2.onnx`,
+    # `openvino/openvino_model_qint8_quantized.xml` etc.
+    ENCODER_MODEL_FILE: str | None = None
+    ENCODER_WORKERS: int = 1
+    # PyTorch threads of a model call. None means CPU cores divided by model calls that may run
+    # at the same time on the server, so that workers don't fight for cores.
+    ENCODER_TORCH_THREADS: int | None = None
+    # Jobs waiting or running; requests beyond that are rejected with 503.
+    ENCODER_QUEUE_MAX_SIZE: int = 64
+    # Concurrent encode calls are merged into one model call of up to this many texts.
+    ENCODER_BATCH_MAX_SIZE: int = 32
+    ENCODER_BATCH_MAX_WAIT: float = 0.005  # 5 ms
+    # Search query embeddings are cached per worker. Zero size disables the cache.
+    ENCODER_QUERY_CACHE_SIZE: int = 1024
+    ENCODER_QUERY_CACHE_TTL: float | None = None  # seconds, None means forever
+
+    # In the async mode notes are saved without waiting for the model, their embeddings are
+    # computed by the embed worker: `python -m app.embed_worker` or, if EMBED_WORKER_IN_APP
+    # is set, a background task of every app worker.
+    EMBEDDING_MODE: EmbeddingMode = EmbeddingMode.SYNC
+    EMBED_WORKER_IN_APP: bool = False
+    EMBED_WORKER_BATCH_SIZE: int = 32
+    EMBED_WORKER_POLL_INTERVAL: float = 1.0  # seconds, when there are no jobs
+    # Jobs taken by a worker are taken by others again after this long, in case it died.
+    # Keep it well above the time a batch takes to embed.
+    EMBED_WORKER_CLAIM_TIMEOUT: float = 5 * 60.0  # seconds
+
+    # Change events streamed to clients. Events a client is too slow to take beyond that
+    # end its stream, the client has to sync changes and reconnect.
+    EVENT_SUBSCRIBER_QUEUE_MAX_SIZE: int = 100
+    # Comments sent on idle streams, so that proxies don't close them.
+    EVENT_STREAM_PING_INTERVAL: float = 15.0  # seconds
+
     def get_database_uri(self, dbname=None) -> PostgresDsn:
         if not dbname:
             dbname = self.POSTGRES_DB
@@ -0,0 +1,21 @@
+import base64
+import binascii
+import json
+
+
+def encode_cursor(values: dict) -> str:
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> dict:
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError('Invalid cursor.') from e
+
+    if not isinstance(values, dict):
+        raise ValueError('Invalid cursor.')
+
+    return values
@@ -1,17 +1,106 @@
-from collections.abc import AsyncGenerator
+import asyncio
+import itertools
+import random
+import time
+from collections.abc import AsyncGenerator, Awaitable, Callable
 from typing import Annotated
 
-from fastapi import Depends
-from sqlalchemy import MetaData
+from fastapi import Depends, HTTPException
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import MetaData, event
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util import LRUCache
 
 from app.core.config import settings
 from app.core.constants import DB_NAMING_CONVENTION
 
+APP_DB_POOL_CHECKOUT_WAIT_SECONDS = Histogram(
+    'app_db_pool_checkout_wait_seconds',
+    'App database connection checkout wait including connecting, seconds',
+    ('app',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+# Gauges of live processes are summed up, every process has its own pool.
+APP_DB_POOL_CHECKED_OUT_CONNECTIONS = Gauge(
+    'app_db_pool_checked_out_connections',
+    'App database connections in use',
+    ('app',),
+    multiprocess_mode='livesum',
+)
+APP_DB_POOL_OVERFLOW_CONNECTIONS = Gauge(
+    'app_db_pool_overflow_connections',
+    'App database connections open beyond the pool size',
+    ('app',),
+    multiprocess_mode='livesum',
+)
+APP_DB_PREPARED_STATEMENT_CACHE_HIT_COUNT = Counter(
+    'app_db_prepared_statement_cache_hit_count',
+    'App asyncpg prepared statement cache hit count',
+    ('app',),
+)
+APP_DB_PREPARED_STATEMENT_CACHE_MISS_COUNT = Counter(
+    'app_db_prepared_statement_cache_miss_count',
+    'App asyncpg prepared statement cache miss count',
+    ('app',),
+)
+APP_DB_TRANSACTION_RETRY_COUNT = Counter(
+    'app_db_transaction_retry_count',
+    'App database transactions run again after a serialization failure or a deadlock',
+    ('app', 'sqlstate'),
+)
+APP_DB_TRANSACTION_RETRY_EXHAUSTED_COUNT = Counter(
+    'app_db_transaction_retry_exhausted_count',
+    'App database transactions failed on every attempt',
+    ('app', 'sqlstate'),
+)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            APP_DB_POOL_CHECKOUT_WAIT_SECONDS.labels(settings.APP_NAME).observe(
+                time.perf_counter() - started_at
+            )
+            self._update_gauges()
+
+    def _do_return_conn(self, record):
+        try:
+            super()._do_return_conn(record)
+        finally:
+            self._update_gauges()
+
+    def _update_gauges(self):
+        APP_DB_POOL_CHECKED_OUT_CONNECTIONS.labels(settings.APP_NAME).set(self.checkedout())
+        APP_DB_POOL_OVERFLOW_CONNECTIONS.labels(settings.APP_NAME).set(max(self.overflow(), 0))
+
+
+class PreparedStatementCache(LRUCache):
+    """
+    The asyncpg adapter looks a statement up and prepares it again if it's missing.
+    A statement that went stale after a schema change counts as both a hit and a miss.
+    """
+
+    def __contains__(self, key):
+        found = super().__contains__(key)
+        if found:
+            APP_DB_PREPARED_STATEMENT_CACHE_HIT_COUNT.labels(settings.APP_NAME).inc()
+        return found
+
+    def __setitem__(self, key, value):
+        APP_DB_PREPARED_STATEMENT_CACHE_MISS_COUNT.labels(settings.APP_NAME).inc()
+        super().__setitem__(key, value)
+
+
 engine = create_async_engine(
     url=str(settings.get_database_uri()),
     isolation_level=settings.ISOLATION_LEVEL,
+    poolclass=InstrumentedPool,
     pool_size=settings.DB_ENGINE_POOL_SIZE,
     pool_recycle=settings.DB_ENGINE_POOL_RECYCLE,
     pool_pre_ping=settings.DB_ENGINE_POOL_PRE_PING,
@@ -19,8 +108,55 @@ engine = create_async_engine(
 )
 metadata = MetaData(naming_convention=DB_NAMING_CONVENTION)
 
+APP_DB_QUERY_DURATION_SECONDS = Histogram(
+    'app_db_query_duration_seconds',
+    'App database query duration, seconds',
+    ('app', 'query_name'),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+# Statements without the `query_name` execution option, ORM flushes among them.
+UNNAMED_QUERY = 'unnamed'
+
+
+@event.listens_for(engine.sync_engine, 'connect')
+def _connect(dbapi_connection, connection_record):
+    # There is no public way to get the adapter cache stats, so replace the cache.
+    cache = dbapi_connection._prepared_statement_cache
+    if cache is not None:
+        dbapi_connection._prepared_statement_cache = PreparedStatementCache(cache.capacity)
+
+
+@event.listens_for(engine.sync_engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.app_query_started_at = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is None:
+        return
+
+    query_name = context.execution_options.get('query_name', UNNAMED_QUERY)
+    APP_DB_QUERY_DURATION_SECONDS.labels(settings.APP_NAME, query_name).observe(
+        time.perf_counter() - context.app_query_started_at
+    )
+
+
 session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
+# Postgres rejects writes in these transactions. The options are reset when the connection
+# is returned to the pool.
+READ_ONLY_EXECUTION_OPTIONS = {
+    'isolation_level': settings.READ_ONLY_ISOLATION_LEVEL,
+    'postgresql_readonly': True,
+}
+read_only_session_factory = sessionmaker(
+    engine.execution_options(**READ_ONLY_EXECUTION_OPTIONS),
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
 
 async def get_session() -> AsyncGenerator[AsyncSession]:
     async with session_factory() as session:
@@ -28,3 +164,63 @@ async def get_session() -> AsyncGenerator[AsyncSession]:
 
 
 SessionDep = Annotated[AsyncSession, Depends(get_session)]
+
+
+async def get_read_only_session() -> AsyncGenerator[AsyncSession]:
+    async with read_only_session_factory() as session:
+        yield session
+
+
+ReadOnlySessionDep = Annotated[AsyncSession, Depends(get_read_only_session)]
+
+# Serialization failure and deadlock, the transaction may succeed when run again.
+RETRYABLE_SQLSTATES = frozenset({'40001', '40P01'})
+
+
+async def run_transaction(session: AsyncSession, work: Callable[[], Awaitable]):
+    """
+    Run the work in a transaction of its own and commit it. When the transaction fails on
+    a serialization failure or a deadlock, it's rolled back and the work is run again.
+
+    The work must read what it changes itself and have no effects outside the transaction.
+    Model inference and the like are done before, so that retries stay cheap and
+    transactions short.
+    """
+    # Reads done before are from an older snapshot, the work starts a new one.
+    if session.in_transaction():
+        await session.commit()
+
+    for attempt in itertools.count(1):
+        try:
+            result = await work()
+            await session.commit()
+            return result
+        except DBAPIError as e:
+            sqlstate = getattr(e.orig, 'sqlstate', None)
+            if sqlstate not in RETRYABLE_SQLSTATES:
+                raise
+
+            await session.rollback()
+            if attempt >= settings.DB_TRANSACTION_MAX_ATTEMPTS:
+                APP_DB_TRANSACTION_RETRY_EXHAUSTED_COUNT.labels(settings.APP_NAME, sqlstate).inc()
+                raise HTTPException(
+                    status_code=503,
+                    detail='Too many concurrent changes. Try again later.',
+                    headers={'Retry-After': '1'},
+                ) from e
+
+            APP_DB_TRANSACTION_RETRY_COUNT.labels(settings.APP_NAME, sqlstate).inc()
+            # Outside of any transaction, nothing is held while waiting.
+            backoff = settings.DB_TRANSACTION_RETRY_BACKOFF * 2 ** (attempt - 1)
+            await asyncio.sleep(random.uniform(0, backoff))
+
+
+def get_session_factory() -> sessionmaker:
+    """
+    For streamed responses. Sessions of dependencies are closed before the response is sent,
+    so a streaming body has to open its own.
+    """
+    return session_factory
+
+
+SessionFactoryDep = Annotated[sessionmaker, Depends(get_session_factory)]
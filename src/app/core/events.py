@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import uuid
+from collections import defaultdict
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+from enum import Enum
+
+import asyncpg
+from sqlalchemy import func, literal, literal_column, select, types
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+EVENT_CHANNEL = 'app_events'
+
+
+class EventAction(str, Enum):
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+
+
+async def notify(
+    session: AsyncSession | AsyncConnection,
+    owner_id: uuid.UUID,
+    entity: str,
+    action: EventAction,
+    ids: list[uuid.UUID],
+):
+    """
+    Send an event of each entity to the listening workers. Postgres delivers them when
+    the transaction commits and drops them when it rolls back.
+    """
+    payloads = [
+        json.dumps(
+            {'owner_id': str(owner_id), 'entity': entity, 'action': action.value, 'id': str(x)}
+        )
+        for x in ids
+    ]
+    if not payloads:
+        return
+
+    # One array parameter, so that the statement is the same for any number of events.
+    payload = (
+        func.unnest(literal(payloads, ARRAY(types.Text))).table_valued('value').render_derived()
+    )
+    await session.execute(
+        select(func.pg_notify(EVENT_CHANNEL, literal_column('value')))
+        .select_from(payload)
+        .execution_options(query_name='event_notify')
+    )
+
+
+class EventBroker:
+    """
+    Fans out the events of one LISTEN connection of the worker to the subscribed streams.
+
+    The connection is opened by the first subscriber. When it is lost, every stream is ended,
+    since events may have been missed, and the next subscriber opens a new one.
+    """
+
+    def __init__(self, queue_max_size: int = settings.EVENT_SUBSCRIBER_QUEUE_MAX_SIZE):
+        self.queue_max_size = queue_max_size
+        self._connection: asyncpg.Connection | None = None
+        self._connect_lock = asyncio.Lock()
+        self._owner_id_to_queues: defaultdict[uuid.UUID, set[asyncio.Queue]] = defaultdict(set)
+
+    @asynccontextmanager
+    async def subscribe(self, owner_id: uuid.UUID) -> AsyncGenerator[asyncio.Queue]:
+        """
+        A queue of the events of the owner. None in the queue means the stream is over
+        and events may have been missed.
+        """
+        await self.start()
+        queue = asyncio.Queue(maxsize=self.queue_max_size)
+        self._owner_id_to_queues[owner_id].add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self._owner_id_to_queues[owner_id]
+            queues.discard(queue)
+            if not queues:
+                del self._owner_id_to_queues[owner_id]
+
+    async def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await connection.close()
+        self._end_streams()
+
+    async def start(self):
+        """Open the LISTEN connection unless it is open."""
+        async with self._connect_lock:
+            if self._connection is not None and not self._connection.is_closed():
+                return
+
+            dsn = str(settings.get_database_uri()).replace('postgresql+asyncpg', 'postgresql')
+            connection = await asyncpg.connect(dsn)
+            connection.add_termination_listener(self._on_termination)
+            await connection.add_listener(EVENT_CHANNEL, self._on_notification)
+            self._connection = connection
+
+    def _on_notification(self, connection, pid, channel, payload: str):
+        event = json.loads(payload)
+        queues = self._owner_id_to_queues.get(uuid.UUID(event['owner_id']))
+        if not queues:
+            return
+
+        del event['owner_id']
+        for queue in list(queues):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Too slow a client, end its stream rather than drop some of its events.
+                queues.discard(queue)
+                self._end_stream(queue)
+
+    def _on_termination(self, connection):
+        if connection is self._connection:
+            logger.warning('The event listener connection is lost.')
+            self._connection = None
+            self._end_streams()
+
+    def _end_streams(self):
+        for queues in self._owner_id_to_queues.values():
+            for queue in queues:
+                self._end_stream(queue)
+        self._owner_id_to_queues.clear()
+
+    @staticmethod
+    def _end_stream(queue: asyncio.Queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+
+async def stream_events(
+    broker: EventBroker,
+    owner_id: uuid.UUID,
+    ping_interval: float = settings.EVENT_STREAM_PING_INTERVAL,
+) -> AsyncGenerator[bytes]:
+    """
+    Server-sent events of the owner. A `resync` event ends the stream when events may have
+    been missed, the client should sync changes before reconnecting.
+    """
+    async with broker.subscribe(owner_id) as queue:
+        yield b': subscribed\n\n'
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), ping_interval)
+            except TimeoutError:
+                yield b': ping\n\n'
+                continue
+
+            if event is None:
+                yield b'event: resync\ndata: {}\n\n'
+                return
+
+            name = f'{event["entity"]}.{event["action"]}'
+            yield f'event: {name}\ndata: {json.dumps(event)}\n\n'.encode()
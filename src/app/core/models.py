@@ -1,9 +1,10 @@
 import datetime as dt
 import re
 import uuid
+from enum import Enum
 
 from pydantic import BaseModel, ConfigDict
-from sqlalchemy import types
+from sqlalchemy import Index, text, types
 from sqlalchemy.orm import (
     DeclarativeBase,
     Mapped,
@@ -59,3 +60,46 @@ class AuditMixin(MappedAsDataclass):
 
 class OwnerMixin(MappedAsDataclass):
     owner_id: Mapped[uuid.UUID] = mapped_column(types.Uuid, nullable=False)
+
+
+# The ID of the transaction writing the row, assigned by the database.
+CURRENT_XACT_ID = text('pg_current_xact_id()::text::bigint')
+
+
+class ChangeMixin(MappedAsDataclass):
+    """
+    Orders changes for clients syncing them. Unlike clocks of the workers, transaction IDs
+    don't depend on when the transaction commits: every one still running is at or above
+    the `xmin` of a new snapshot, so changes below it are final.
+    """
+
+    change_xid: Mapped[int] = mapped_column(
+        types.BigInteger,
+        server_default=CURRENT_XACT_ID,
+        onupdate=CURRENT_XACT_ID,
+        nullable=False,
+        init=False,
+        repr=False,
+        compare=False,
+    )
+
+
+class DeletedEntity(str, Enum):
+    NOTE = 'note'
+    TAG = 'tag'
+
+
+class DeletionLog(PrimaryUUIDMixin, ChangeMixin, OwnerMixin, BaseSQLModel):
+    """A deleted note or tag. Lets clients syncing changes remove their copies."""
+
+    __table_args__ = (Index('deletion_log_owner_id_change_xid_idx', 'owner_id', 'change_xid'),)
+
+    # One of DeletedEntity.
+    entity: Mapped[str] = mapped_column(types.String(16), nullable=False)
+    entity_id: Mapped[uuid.UUID] = mapped_column(types.Uuid, nullable=False)
+    deleted_at: Mapped[dt.datetime] = mapped_column(
+        types.DateTime(timezone=True),
+        default_factory=lambda: dt.datetime.now(dt.timezone.utc),
+        nullable=False,
+        kw_only=True,
+    )
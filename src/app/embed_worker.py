@@ -0,0 +1,53 @@
+import asyncio
+import logging
+import signal
+
+from app.core.config import settings
+from app.core.db import session_factory
+from app.middlewares.metrics import mark_process_dead
+from app.server import configure_logging
+from app.slices.note.encoder import Encoder, create_encoder
+from app.slices.note.service import embed_pending_notes
+
+logger = logging.getLogger(__name__)
+
+
+async def run(encoder: Encoder):
+    """Do note embedding jobs until cancelled."""
+    while True:
+        try:
+            async with session_factory() as session:
+                done = await embed_pending_notes(
+                    session,
+                    encoder,
+                    settings.EMBED_WORKER_BATCH_SIZE,
+                )
+        except Exception:
+            logger.exception('Failed to do note embedding jobs.')
+            done = 0
+
+        # Take the next batch right away while the queue is not empty.
+        if done < settings.EMBED_WORKER_BATCH_SIZE:
+            await asyncio.sleep(settings.EMBED_WORKER_POLL_INTERVAL)
+
+
+async def main():
+    encoder = create_encoder()
+    task = asyncio.create_task(run(encoder))
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+
+    try:
+        await task
+    except asyncio.CancelledError:
+        logger.info('The embed worker was stopped.')
+    finally:
+        encoder.close()
+        mark_process_dead()
+
+
+if __name__ == '__main__':
+    configure_logging()
+    asyncio.run(main())
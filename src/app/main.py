@@ -1,11 +1,13 @@
-from contextlib import asynccontextmanager
+import asyncio
+from contextlib import asynccontextmanager, suppress
 
 from fastapi import APIRouter, FastAPI
-from sentence_transformers import SentenceTransformer
 
-from app.core.config import settings
-from app.middlewares.metrics import MetricsMiddleware, metrics_route
-from app.slices.note.constants import SENTENCE_TRANSFORMERS_MODEL
+from app.core.config import EmbeddingMode, settings
+from app.core.events import EventBroker
+from app.embed_worker import run as run_embed_worker
+from app.middlewares.metrics import MetricsMiddleware, mark_process_dead, metrics_route
+from app.slices.note.encoder import create_encoder
 from app.slices.note.router import router as notes_router
 from app.slices.tag.router import router as tag_router
 
@@ -16,9 +18,27 @@ router.include_router(tag_router, prefix='/tags', tags=['tags'])
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
-    yield {
-        'st': SentenceTransformer(SENTENCE_TRANSFORMERS_MODEL),
-    }
+    encoder = create_encoder()
+    # Connects when the first client subscribes.
+    event_broker = EventBroker()
+
+    embed_worker_task = None
+    if settings.EMBEDDING_MODE == EmbeddingMode.ASYNC and settings.EMBED_WORKER_IN_APP:
+        embed_worker_task = asyncio.create_task(run_embed_worker(encoder))
+
+    try:
+        yield {
+            'encoder': encoder,
+            'event_broker': event_broker,
+        }
+    finally:
+        if embed_worker_task is not None:
+            embed_worker_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await embed_worker_task
+        await event_broker.close()
+        encoder.close()
+        mark_process_dead()
 
 
 app = FastAPI(
@@ -1,3 +1,4 @@
+import os
 import time
 from collections import namedtuple
 
@@ -10,7 +11,7 @@ from prometheus_client import (
     generate_latest,
     multiprocess,
 )
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
 from app.core.config import PATHES_TO_SKIP_METRICS_FOR, settings
 
@@ -30,39 +31,54 @@ APP_HTTP_REQUEST_COUNT = Counter(
 )
 
 
-class MetricsMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next) -> Response:
-        path = request.url.path
-        if path in PATHES_TO_SKIP_METRICS_FOR:
-            return await call_next(request)
+# Requests that matched no route, they must not create a time series per path.
+UNMATCHED_PATH = '<unmatched>'
 
-        exception = None
-        try:
-            start_at = time.perf_counter()
-            response = await call_next(request)
-        except Exception as e:
-            exception = e
 
-        end_at = time.perf_counter()
+class MetricsMiddleware:
+    """
+    A pure ASGI middleware: unlike `BaseHTTPMiddleware` it doesn't run the app in a separate
+    task and doesn't pass the response body through a stream.
 
-        if exception:
-            status_code = 500
-        else:
-            status_code = response.status_code
+    Requests are labeled with the path template of the matched route, e.g. `/notes/{id}`.
+    The duration includes sending the whole body of streaming responses.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
 
-        labels = base_http_request_metric_labels(
-            app=settings.APP_NAME,
-            path=path,
-            method=request.method,
-            status_code=status_code,
-        )
-        APP_HTTP_REQUEST_DURATION_SECONDS.labels(*labels).observe(end_at - start_at)
-        APP_HTTP_REQUEST_COUNT.labels(*labels).inc()
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['path'] in PATHES_TO_SKIP_METRICS_FOR:
+            await self.app(scope, receive, send)
+            return
 
-        if exception:
-            raise exception
+        status_code = 500
 
-        return response
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        start_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            status_code = 500
+            raise
+        finally:
+            end_at = time.perf_counter()
+
+            # The router puts the matched route into the scope.
+            route = scope.get('route')
+            labels = base_http_request_metric_labels(
+                app=settings.APP_NAME,
+                path=route.path if route else UNMATCHED_PATH,
+                method=scope['method'],
+                status_code=status_code,
+            )
+            APP_HTTP_REQUEST_DURATION_SECONDS.labels(*labels).observe(end_at - start_at)
+            APP_HTTP_REQUEST_COUNT.labels(*labels).inc()
 
 
 def metrics_route(_: Request):
@@ -73,3 +89,12 @@ def metrics_route(_: Request):
         status_code=200,
         headers={'Content-Type': CONTENT_TYPE_LATEST},
     )
+
+
+def mark_process_dead():
+    """
+    Drop values of live gauges of the current process. Call it when the process exits,
+    otherwise its last values are added up until the server is restarted.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,65 @@
+"""Add the note embedding job table.
+
+Revision ID: 0e6b3f7a91c4
+Revises: c2a85f3e9b40
+Create Date: 2025-11-17 15:21:46.230918
+
+"""
+
+from typing import Sequence, Union
+
+import pgvector
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '0e6b3f7a91c4'
+down_revision: Union[str, Sequence[str], None] = 'c2a85f3e9b40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'note_embedding_job',
+        sa.Column('note_id', sa.Uuid(), nullable=False),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('claimed_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('id', sa.Uuid(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['note_id'],
+            ['note.id'],
+            name=op.f('note_embedding_job_note_id_fkey'),
+            ondelete='CASCADE',
+        ),
+        sa.PrimaryKeyConstraint('id', name=op.f('note_embedding_job_pkey')),
+        sa.UniqueConstraint('note_id', name=op.f('note_embedding_job_note_id_key')),
+    )
+    op.create_index(
+        op.f('note_embedding_job_created_at_idx'),
+        'note_embedding_job',
+        ['created_at'],
+        unique=False,
+    )
+    op.alter_column(
+        'note',
+        'embedding',
+        existing_type=pgvector.sqlalchemy.vector.VECTOR(dim=384),
+        nullable=True,
+    )
+    op.alter_column('note', 'embedding_source_hash', existing_type=sa.String(64), nullable=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Fails if there are notes that have not been embedded yet. Let the embed worker finish first.
+    op.alter_column('note', 'embedding_source_hash', existing_type=sa.String(64), nullable=False)
+    op.alter_column(
+        'note',
+        'embedding',
+        existing_type=pgvector.sqlalchemy.vector.VECTOR(dim=384),
+        nullable=False,
+    )
+    op.drop_index(op.f('note_embedding_job_created_at_idx'), table_name='note_embedding_job')
+    op.drop_table('note_embedding_job')
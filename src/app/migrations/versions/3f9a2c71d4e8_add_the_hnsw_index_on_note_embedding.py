@@ -0,0 +1,44 @@
+"""Add the HNSW index on note embedding.
+
+Revision ID: 3f9a2c71d4e8
+Revises: aee8b2a9dbc1
+Create Date: 2025-11-03 10:12:41.208315
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9a2c71d4e8'
+down_revision: Union[str, Sequence[str], None] = 'aee8b2a9dbc1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Building an HNSW index takes a while, so don't lock the table for writes meanwhile.
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f('note_embedding_idx'),
+            'note',
+            ['embedding'],
+            unique=False,
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding': 'vector_cosine_ops'},
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            op.f('note_embedding_idx'),
+            table_name='note',
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,85 @@
+"""Add the deletion log table.
+
+Revision ID: 4a8f0d6c2e71
+Revises: 7c1d2e5f8a39
+Create Date: 2025-12-02 11:08:53.614207
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '4a8f0d6c2e71'
+down_revision: Union[str, Sequence[str], None] = '7c1d2e5f8a39'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+CHANGED_TABLES = ('note', 'tag')
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'deletion_log',
+        sa.Column('entity', sa.String(16), nullable=False),
+        sa.Column('entity_id', sa.Uuid(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column(
+            'change_xid',
+            sa.BigInteger(),
+            server_default=sa.text('pg_current_xact_id()::text::bigint'),
+            nullable=False,
+        ),
+        sa.Column('id', sa.Uuid(), nullable=False),
+        sa.Column('owner_id', sa.Uuid(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('deletion_log_pkey')),
+    )
+    op.create_index(
+        op.f('deletion_log_owner_id_change_xid_idx'),
+        'deletion_log',
+        ['owner_id', 'change_xid'],
+        unique=False,
+    )
+    for table in CHANGED_TABLES:
+        # A constant default doesn't rewrite the table. Existing rows come first in the changes,
+        # the transaction ID is the default of new rows only.
+        op.add_column(
+            table,
+            sa.Column('change_xid', sa.BigInteger(), server_default='0', nullable=False),
+        )
+        op.alter_column(
+            table,
+            'change_xid',
+            server_default=sa.text('pg_current_xact_id()::text::bigint'),
+        )
+
+    # Every statement below commits on its own, so the tables are never locked for long
+    # and the migration can be applied to a live database.
+    with op.get_context().autocommit_block():
+        for table in CHANGED_TABLES:
+            op.create_index(
+                op.f(f'{table}_owner_id_change_xid_idx'),
+                table,
+                ['owner_id', 'change_xid'],
+                unique=False,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for table in CHANGED_TABLES:
+            op.drop_index(
+                op.f(f'{table}_owner_id_change_xid_idx'),
+                table_name=table,
+                postgresql_concurrently=True,
+            )
+
+    for table in CHANGED_TABLES:
+        op.drop_column(table, 'change_xid')
+    op.drop_index(op.f('deletion_log_owner_id_change_xid_idx'), table_name='deletion_log')
+    op.drop_table('deletion_log')
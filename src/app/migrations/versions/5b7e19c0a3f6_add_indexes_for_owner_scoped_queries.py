@@ -0,0 +1,89 @@
+"""Add indexes for owner scoped queries.
+
+Revision ID: 5b7e19c0a3f6
+Revises: 3f9a2c71d4e8
+Create Date: 2025-11-05 16:47:02.731950
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '5b7e19c0a3f6'
+down_revision: Union[str, Sequence[str], None] = '3f9a2c71d4e8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Every statement below commits on its own, so the tables are never locked for long
+    # and the migration can be applied to a live database.
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f('note_owner_id_created_at_idx'),
+            'note',
+            ['owner_id', sa.text('created_at DESC')],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+        # The table has no primary key yet, so clean it up before making one.
+        op.execute('DELETE FROM note_tag_m2m WHERE note_id IS NULL OR tag_id IS NULL')
+        op.execute(
+            'DELETE FROM note_tag_m2m a USING note_tag_m2m b '
+            'WHERE a.note_id = b.note_id AND a.tag_id = b.tag_id AND a.ctid > b.ctid'
+        )
+
+        op.create_index(
+            op.f('note_tag_m2m_pkey'),
+            'note_tag_m2m',
+            ['note_id', 'tag_id'],
+            unique=True,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            op.f('note_tag_m2m_tag_id_note_id_idx'),
+            'note_tag_m2m',
+            ['tag_id', 'note_id'],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+        # SET NOT NULL skips the full table scan under an exclusive lock
+        # when a validated check constraint already proves it.
+        for column in ('note_id', 'tag_id'):
+            check_name = f'note_tag_m2m_{column}_not_null_check'
+            op.execute(
+                f'ALTER TABLE note_tag_m2m ADD CONSTRAINT {check_name} '
+                f'CHECK ({column} IS NOT NULL) NOT VALID'
+            )
+            op.execute(f'ALTER TABLE note_tag_m2m VALIDATE CONSTRAINT {check_name}')
+            op.alter_column('note_tag_m2m', column, existing_type=sa.Uuid(), nullable=False)
+            op.drop_constraint(op.f(check_name), 'note_tag_m2m', type_='check')
+
+        op.execute(
+            'ALTER TABLE note_tag_m2m ADD CONSTRAINT note_tag_m2m_pkey '
+            'PRIMARY KEY USING INDEX note_tag_m2m_pkey'
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_constraint(op.f('note_tag_m2m_pkey'), 'note_tag_m2m', type_='primary')
+        op.alter_column('note_tag_m2m', 'tag_id', existing_type=sa.Uuid(), nullable=True)
+        op.alter_column('note_tag_m2m', 'note_id', existing_type=sa.Uuid(), nullable=True)
+        op.drop_index(
+            op.f('note_tag_m2m_tag_id_note_id_idx'),
+            table_name='note_tag_m2m',
+            postgresql_concurrently=True,
+        )
+        op.drop_index(
+            op.f('note_owner_id_created_at_idx'),
+            table_name='note',
+            postgresql_concurrently=True,
+        )
@@ -0,0 +1,59 @@
+"""Add the note search vector column.
+
+Revision ID: 7c1d2e5f8a39
+Revises: 0e6b3f7a91c4
+Create Date: 2025-11-20 10:12:54.671382
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '7c1d2e5f8a39'
+down_revision: Union[str, Sequence[str], None] = '0e6b3f7a91c4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Adding a stored generated column rewrites the table under an exclusive lock.
+    op.add_column(
+        'note',
+        sa.Column(
+            'search_vector',
+            postgresql.TSVECTOR(),
+            sa.Computed(
+                "setweight(to_tsvector('simple', name), 'A') || "
+                "setweight(to_tsvector('simple', content), 'B')",
+                persisted=True,
+            ),
+            nullable=True,
+        ),
+    )
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f('note_search_vector_idx'),
+            'note',
+            ['search_vector'],
+            unique=False,
+            postgresql_using='gin',
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            op.f('note_search_vector_idx'),
+            table_name='note',
+            postgresql_concurrently=True,
+        )
+
+    op.drop_column('note', 'search_vector')
@@ -7,9 +7,8 @@ Create Date: 2025-09-17 13:35:50.358480
 """
 from typing import Sequence, Union
 
-from alembic import op
 import sqlalchemy as sa
-
+from alembic import op
 
 # revision identifiers, used by Alembic.
 revision: str = '86bcda727b2f'
@@ -0,0 +1,50 @@
+"""Add the embedding source hash column.
+
+Revision ID: 9d4c8e2b6a17
+Revises: 5b7e19c0a3f6
+Create Date: 2025-11-10 12:05:33.418207
+
+"""
+
+from typing import Sequence, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = '9d4c8e2b6a17'
+down_revision: Union[str, Sequence[str], None] = '5b7e19c0a3f6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('note', sa.Column('embedding_source_hash', sa.String(length=64), nullable=True))
+    # Same as app.slices.note.service.get_embedding_source: empty parts are skipped.
+    op.execute(
+        'UPDATE note SET embedding_source_hash = encode('
+        "sha256(convert_to(concat_ws('. ', nullif(name, ''), nullif(content, '')), 'UTF8')), "
+        "'hex')"
+    )
+    op.alter_column('note', 'embedding_source_hash', existing_type=sa.String(64), nullable=False)
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f('note_owner_id_embedding_source_hash_idx'),
+            'note',
+            ['owner_id', 'embedding_source_hash'],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            op.f('note_owner_id_embedding_source_hash_idx'),
+            table_name='note',
+            postgresql_concurrently=True,
+        )
+    op.drop_column('note', 'embedding_source_hash')
@@ -0,0 +1,75 @@
+"""Add note chunks.
+
+Revision ID: c2a85f3e9b40
+Revises: 9d4c8e2b6a17
+Create Date: 2025-11-14 09:38:17.905126
+
+"""
+
+from typing import Sequence, Union
+
+import pgvector
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = 'c2a85f3e9b40'
+down_revision: Union[str, Sequence[str], None] = '9d4c8e2b6a17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        'note_chunk',
+        sa.Column('note_id', sa.Uuid(), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('text_hash', sa.String(length=64), nullable=False),
+        sa.Column('embedding', pgvector.sqlalchemy.vector.VECTOR(dim=384), nullable=False),
+        sa.Column('owner_id', sa.Uuid(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ['note_id'],
+            ['note.id'],
+            name=op.f('note_chunk_note_id_fkey'),
+            ondelete='CASCADE',
+        ),
+        sa.PrimaryKeyConstraint('note_id', 'position', name=op.f('note_chunk_pkey')),
+    )
+    # Model inference is not available here, so every note gets a single chunk
+    # with its current embedding. Long notes are split once their text is changed.
+    op.execute(
+        'INSERT INTO note_chunk (note_id, position, text_hash, embedding, owner_id) '
+        'SELECT id, 0, embedding_source_hash, embedding, owner_id FROM note'
+    )
+    op.drop_index(op.f('note_owner_id_embedding_source_hash_idx'), table_name='note')
+
+    with op.get_context().autocommit_block():
+        op.create_index(
+            op.f('note_chunk_owner_id_text_hash_idx'),
+            'note_chunk',
+            ['owner_id', 'text_hash'],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            op.f('note_chunk_embedding_idx'),
+            'note_chunk',
+            ['embedding'],
+            unique=False,
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding': 'vector_cosine_ops'},
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index(
+        op.f('note_owner_id_embedding_source_hash_idx'),
+        'note',
+        ['owner_id', 'embedding_source_hash'],
+        unique=False,
+    )
+    op.drop_table('note_chunk')
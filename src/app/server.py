@@ -4,7 +4,7 @@ import shutil
 
 import uvicorn
 
-from app.core.config import settings
+from app.core.config import EncoderExecutor, settings
 
 logger = logging.getLogger(__name__)
 
@@ -21,8 +21,10 @@ def setup_prometheus_multiproc_dir():
     """
     Reason: https://prometheus.github.io/client_python/multiprocess/
 
-    Note that we don't call prometheus_client.multiprocess.mark_process_dead(dead_worker_pid).
-    It does nothing since we don't collect metrics of the gauge type.
+    Database pool gauges are summed up over live processes. A worker calls
+    prometheus_client.multiprocess.mark_process_dead() for itself when it shuts down,
+    see app.middlewares.metrics.mark_process_dead. Values of a killed worker stay until
+    the next start, which recreates the directory.
     """
     env_var_name = 'PROMETHEUS_MULTIPROC_DIR'
     dir_perm = 0o744
@@ -47,12 +49,25 @@ def setup_prometheus_multiproc_dir():
 if __name__ == '__main__':
     configure_logging()
     setup_prometheus_multiproc_dir()
-    uvicorn.run(
-        app='app.main:app',
-        host=settings.UVICORN_HOST,
-        port=settings.UVICORN_PORT,
-        workers=settings.UVICORN_WORKERS,
-        # Make uvicorn use the default logger configuration.
-        log_config=None,
-        log_level=None,
-    )
+
+    encoder_host_process = None
+    if settings.ENCODER_EXECUTOR == EncoderExecutor.HOST:
+        # Imported here, so that the supervisor loads the model libraries only to host it.
+        from app.slices.note import encoder_host
+
+        encoder_host_process = encoder_host.start()
+
+    try:
+        uvicorn.run(
+            app='app.main:app',
+            host=settings.UVICORN_HOST,
+            port=settings.UVICORN_PORT,
+            workers=settings.UVICORN_WORKERS,
+            # Make uvicorn use the default logger configuration.
+            log_config=None,
+            log_level=None,
+        )
+    finally:
+        if encoder_host_process is not None:
+            encoder_host_process.terminate()
+            encoder_host_process.join()
@@ -4,6 +4,34 @@ NOTE_NAME_MAX_LENGTH = 255
 
 NOTE_PAGE_SIZE = 10
 NOTE_PAGE_LIMIT_MAX = 25
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+# Tags per filter of the note list.
+NOTE_TAG_FILTER_MAX_LENGTH = 10
+NOTE_SNIPPET_LENGTH_MAX = 1000
+# Notes per request of the batched similar notes.
+NOTE_SIMILAR_IDS_MAX_LENGTH = 25
+
+NOTE_BULK_MAX_SIZE = 10_000
+# Notes of an import embedded by one encoder call.
+NOTE_BULK_EMBED_BATCH_SIZE = 256
+# Notes fetched from the server-side cursor at once by the export.
+NOTE_EXPORT_BATCH_SIZE = 500
+
+NOTE_CHANGES_PAGE_SIZE = 100
+NOTE_CHANGES_PAGE_SIZE_MAX = 1000
+# Used to turn a snippet length into the number of words of a search result fragment.
+NOTE_SNIPPET_CHARS_PER_WORD = 6
+
+NOTE_SEARCH_MIN_SCORE = 0.1
+NOTE_SEARCH_CHUNK_OVERFETCH = 4
+# Hybrid search merges this many best notes of each search at least.
+NOTE_SEARCH_HYBRID_CANDIDATE_COUNT = 50
+# The usual constant of reciprocal rank fusion, it damps the weight of the top ranks.
+NOTE_SEARCH_RRF_K = 60
+
+# The model sees at most 256 tokens, notes are embedded by chunks of this many tokens.
+NOTE_CHUNK_SIZE = 200
+NOTE_CHUNK_OVERLAP = 32
 
 SENTENCE_TRANSFORMERS_MODEL = 'all-MiniLM-L6-v2'
 SENTENCE_TRANSFORMERS_EMBEDDING_SIZE = 384
@@ -0,0 +1,415 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from fastapi import HTTPException
+from prometheus_client import Counter, Histogram
+
+from app.core.config import EncoderBackend, EncoderExecutor, settings
+
+from .constants import SENTENCE_TRANSFORMERS_MODEL
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+APP_ENCODER_QUEUE_DEPTH = Histogram(
+    'app_encoder_queue_depth',
+    'App encoder jobs waiting or running at the time a new job is submitted',
+    ('app',),
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128),
+)
+APP_ENCODER_QUEUE_WAIT_SECONDS = Histogram(
+    'app_encoder_queue_wait_seconds',
+    'App encoder job wait time for a free executor worker, seconds',
+    ('app',),
+)
+APP_ENCODER_JOB_DURATION_SECONDS = Histogram(
+    'app_encoder_job_duration_seconds',
+    'App encoder job duration in an executor worker, seconds',
+    ('app', 'job'),
+)
+APP_ENCODER_BATCH_SIZE = Histogram(
+    'app_encoder_batch_size',
+    'App encoder texts per model call',
+    ('app',),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+APP_QUERY_EMBEDDING_CACHE_HIT_COUNT = Counter(
+    'app_query_embedding_cache_hit_count',
+    'App query embedding cache hit count',
+    ('app',),
+)
+APP_QUERY_EMBEDDING_CACHE_MISS_COUNT = Counter(
+    'app_query_embedding_cache_miss_count',
+    'App query embedding cache miss count',
+    ('app',),
+)
+APP_QUERY_EMBEDDING_CACHE_EVICTION_COUNT = Counter(
+    'app_query_embedding_cache_eviction_count',
+    'App query embedding cache eviction count',
+    ('app',),
+)
+
+# The model of the current process. Executor workers call `encode` which uses it.
+_model: 'SentenceTransformer | None' = None
+
+
+def create_model(backend: EncoderBackend, model_file: str | None = None) -> 'SentenceTransformer':
+    # The model libraries are imported by the processes running the model only. App workers
+    # sending jobs to the encoder host never load them.
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(
+        SENTENCE_TRANSFORMERS_MODEL,
+        backend=backend.value,
+        model_kwargs={'file_name': model_file} if model_file else None,
+    )
+
+
+def get_torch_threads() -> int:
+    if settings.ENCODER_TORCH_THREADS:
+        return settings.ENCODER_TORCH_THREADS
+
+    model_processes = 1
+    if settings.ENCODER_EXECUTOR != EncoderExecutor.HOST:
+        model_processes = settings.UVICORN_WORKERS
+
+    model_calls = model_processes * settings.ENCODER_WORKERS
+    return max(1, (os.process_cpu_count() or 1) // model_calls)
+
+
+def load_model():
+    import torch
+
+    global _model
+    # Every thread running the model gets a pool of this many threads.
+    torch.set_num_threads(get_torch_threads())
+    _model = create_model(settings.ENCODER_BACKEND, settings.ENCODER_MODEL_FILE)
+
+
+def encode(texts: list[str]) -> list[list[float]]:
+    return _model.encode(texts).tolist()
+
+
+def split(texts: list[str], size: int, overlap: int) -> list[list[str]]:
+    """
+    Split each text into chunks of `size` tokens, neighbours share `overlap` tokens.
+    The texts are tokenized together, so a batch of them is one executor job.
+    """
+    encoding = _model.tokenizer(
+        texts,
+        add_special_tokens=False,
+        return_offsets_mapping=True,
+        verbose=False,
+    )
+    return [
+        split_by_offsets(text, offsets, size, overlap)
+        for text, offsets in zip(texts, encoding['offset_mapping'])
+    ]
+
+
+def split_by_offsets(
+    text: str,
+    offsets: list[tuple[int, int]],
+    size: int,
+    overlap: int,
+) -> list[str]:
+    if len(offsets) <= size:
+        return [text]
+
+    chunks = []
+    for start in range(0, len(offsets), size - overlap):
+        window = offsets[start : start + size]
+        chunks.append(text[window[0][0] : window[-1][1]])
+        if start + size >= len(offsets):
+            break
+
+    return chunks
+
+
+def normalize_query(query: str) -> str:
+    # The model lowercases its input and ignores extra whitespace anyway.
+    return ' '.join(query.split()).lower()
+
+
+class EmbeddingCache:
+    """LRU cache of embeddings. Entries older than `ttl` seconds are treated as missing."""
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._items: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+
+    def get(self, key: str) -> list[float] | None:
+        item = self._items.get(key)
+        if item is not None:
+            created_at, embedding = item
+            if self._ttl is None or time.monotonic() - created_at < self._ttl:
+                self._items.move_to_end(key)
+                APP_QUERY_EMBEDDING_CACHE_HIT_COUNT.labels(settings.APP_NAME).inc()
+                return embedding
+
+            del self._items[key]
+            APP_QUERY_EMBEDDING_CACHE_EVICTION_COUNT.labels(settings.APP_NAME).inc()
+
+        APP_QUERY_EMBEDDING_CACHE_MISS_COUNT.labels(settings.APP_NAME).inc()
+        return None
+
+    def set(self, key: str, embedding: list[float]):
+        self._items[key] = (time.monotonic(), embedding)
+        self._items.move_to_end(key)
+        while len(self._items) > self._max_size:
+            self._items.popitem(last=False)
+            APP_QUERY_EMBEDDING_CACHE_EVICTION_COUNT.labels(settings.APP_NAME).inc()
+
+
+def send_message(sock: socket.socket, message: dict):
+    data = json.dumps(message).encode()
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def receive_message(sock: socket.socket) -> dict:
+    [size] = struct.unpack('>I', _receive_exactly(sock, 4))
+    return json.loads(_receive_exactly(sock, size))
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('The encoder host closed the connection.')
+        data += chunk
+    return bytes(data)
+
+
+class HostExecutor(Executor):
+    """
+    Sends jobs to the encoder host process instead of running them. Every thread keeps
+    its own connection, so jobs of one worker run on the host concurrently too.
+    """
+
+    def __init__(self, path: str, max_workers: int):
+        self._path = path
+        self._threads = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix='encoder-host-client',
+        )
+        self._local = threading.local()
+        self._sockets: list[socket.socket] = []
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        # Only module level functions are sent, the host runs its own copy of them.
+        return self._threads.submit(self._call, fn.__name__, list(args))
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self._threads.shutdown(wait, cancel_futures=cancel_futures)
+        for sock in self._sockets:
+            sock.close()
+
+    def _call(self, fn_name: str, args: list):
+        sock = getattr(self._local, 'socket', None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self._path)
+            self._local.socket = sock
+            self._sockets.append(sock)
+
+        try:
+            send_message(sock, {'fn': fn_name, 'args': args})
+            response = receive_message(sock)
+        except OSError:
+            # The host may have been restarted, connect again next time.
+            self._local.socket = None
+            self._sockets.remove(sock)
+            sock.close()
+            raise
+
+        if 'error' not in response:
+            return response['result']
+        if 'status_code' in response:
+            raise HTTPException(status_code=response['status_code'], detail=response['error'])
+        raise RuntimeError(f'The encoder host failed: {response["error"]}')
+
+
+class Encoder:
+    """
+    Runs the model in a dedicated executor so the event loop is never blocked by inference.
+
+    At most `workers` jobs are handed to the executor at once, the rest wait on the loop.
+    Concurrent `encode` calls are collected for up to `batch_max_wait` seconds and embedded
+    by a single model call, which is much cheaper than one call per text.
+    """
+
+    def __init__(
+        self,
+        executor: Executor,
+        workers: int,
+        queue_max_size: int,
+        batch_max_size: int = 1,
+        batch_max_wait: float = 0,
+        query_cache: EmbeddingCache | None = None,
+    ):
+        self._executor = executor
+        self._semaphore = asyncio.Semaphore(workers)
+        self._queue_max_size = queue_max_size
+        self._queue_depth = 0
+
+        self._batch_max_size = batch_max_size
+        self._batch_max_wait = batch_max_wait
+        self._batch: list[tuple[list[str], asyncio.Future]] = []
+        self._batch_size = 0
+        self._batch_timer: asyncio.TimerHandle | None = None
+        self._batch_tasks: set[asyncio.Task] = set()
+
+        self._query_cache = query_cache
+
+    async def encode(self, texts: list[str]) -> list[list[float]]:
+        if len(texts) >= self._batch_max_size:
+            return await self._encode(texts)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((texts, future))
+        self._batch_size += len(texts)
+
+        if self._batch_size >= self._batch_max_size:
+            self._flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = loop.call_later(self._batch_max_wait, self._flush_batch)
+
+        return await future
+
+    async def encode_query(self, query: str) -> list[float]:
+        """Embed a search query. Repeated queries are served from the cache."""
+        key = normalize_query(query)
+        if self._query_cache is None:
+            [embedding] = await self.encode([key])
+            return embedding
+
+        embedding = self._query_cache.get(key)
+        if embedding is None:
+            [embedding] = await self.encode([key])
+            self._query_cache.set(key, embedding)
+        return embedding
+
+    async def split(self, texts: list[str], size: int, overlap: int) -> list[list[str]]:
+        """
+        Split the texts into chunks, see `split`. All of them take one job, however many
+        there are, so large imports stay within the queue limit.
+        """
+        # A token takes at least one character, so a short text is one chunk for sure.
+        long_texts = [x for x in texts if len(x) > size]
+        if not long_texts:
+            return [[x] for x in texts]
+
+        long_text_chunks = iter(await self._run(split, long_texts, size, overlap))
+        return [next(long_text_chunks) if len(x) > size else [x] for x in texts]
+
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+
+        task = asyncio.create_task(self._run_batch(batch))
+        # Keep a reference, otherwise the task may be garbage collected before it is done.
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _run_batch(self, batch: list[tuple[list[str], asyncio.Future]]):
+        texts = [text for batch_texts, _ in batch for text in batch_texts]
+        try:
+            embeddings = await self._encode(texts)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for batch_texts, future in batch:
+            end = start + len(batch_texts)
+            if not future.done():
+                future.set_result(embeddings[start:end])
+            start = end
+
+    async def _encode(self, texts: list[str]) -> list[list[float]]:
+        APP_ENCODER_BATCH_SIZE.labels(settings.APP_NAME).observe(len(texts))
+        return await self._run(encode, texts)
+
+    async def _run(self, fn, *args):
+        if self._queue_depth >= self._queue_max_size:
+            raise HTTPException(status_code=503, detail='The encoder is overloaded. Try later.')
+
+        APP_ENCODER_QUEUE_DEPTH.labels(settings.APP_NAME).observe(self._queue_depth)
+        self._queue_depth += 1
+        try:
+            submitted_at = time.perf_counter()
+            async with self._semaphore:
+                APP_ENCODER_QUEUE_WAIT_SECONDS.labels(settings.APP_NAME).observe(
+                    time.perf_counter() - submitted_at
+                )
+                loop = asyncio.get_running_loop()
+                started_at = time.perf_counter()
+                try:
+                    return await loop.run_in_executor(self._executor, fn, *args)
+                finally:
+                    APP_ENCODER_JOB_DURATION_SECONDS.labels(settings.APP_NAME, fn.__name__).observe(
+                        time.perf_counter() - started_at
+                    )
+        finally:
+            self._queue_depth -= 1
+
+    def close(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+        self._executor.shutdown(cancel_futures=True)
+
+
+def create_encoder(executor_type: EncoderExecutor | None = None) -> Encoder:
+    if executor_type is None:
+        executor_type = settings.ENCODER_EXECUTOR
+
+    if executor_type == EncoderExecutor.HOST:
+        executor = HostExecutor(settings.ENCODER_HOST_SOCKET, max_workers=settings.ENCODER_WORKERS)
+    elif executor_type == EncoderExecutor.PROCESS:
+        executor = ProcessPoolExecutor(
+            max_workers=settings.ENCODER_WORKERS,
+            # Forking a process with a running event loop and torch threads is not safe.
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=load_model,
+        )
+    else:
+        load_model()
+        executor = ThreadPoolExecutor(
+            max_workers=settings.ENCODER_WORKERS,
+            thread_name_prefix='encoder',
+        )
+
+    query_cache = None
+    if settings.ENCODER_QUERY_CACHE_SIZE > 0:
+        query_cache = EmbeddingCache(
+            max_size=settings.ENCODER_QUERY_CACHE_SIZE,
+            ttl=settings.ENCODER_QUERY_CACHE_TTL,
+        )
+
+    return Encoder(
+        executor,
+        workers=settings.ENCODER_WORKERS,
+        queue_max_size=settings.ENCODER_QUEUE_MAX_SIZE,
+        batch_max_size=settings.ENCODER_BATCH_MAX_SIZE,
+        batch_max_wait=settings.ENCODER_BATCH_MAX_WAIT,
+        query_cache=query_cache,
+    )
@@ -0,0 +1,115 @@
+"""
+The encoder host process runs the only copy of the model on the server. App workers send
+jobs to it over a Unix socket, see `HostExecutor`.
+"""
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import struct
+import time
+from multiprocessing.process import BaseProcess
+
+from fastapi import HTTPException
+
+from app.core.config import EncoderExecutor, settings
+
+from .encoder import Encoder, create_encoder, receive_message, send_message
+
+logger = logging.getLogger(__name__)
+
+
+async def handle_connection(
+    encoder: Encoder,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+):
+    # The encoder merges jobs of all connections into batches.
+    fns = {
+        'encode': encoder.encode,
+        'split': encoder.split,
+    }
+    try:
+        while True:
+            try:
+                [size] = struct.unpack('>I', await reader.readexactly(4))
+                request = json.loads(await reader.readexactly(size))
+            except asyncio.IncompleteReadError:
+                break
+
+            try:
+                response = {'result': await fns[request['fn']](*request['args'])}
+            except HTTPException as e:
+                response = {'error': e.detail, 'status_code': e.status_code}
+            except Exception as e:
+                logger.exception('Failed to run the %s job.', request['fn'])
+                response = {'error': repr(e)}
+
+            data = json.dumps(response).encode()
+            writer.write(struct.pack('>I', len(data)) + data)
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve():
+    encoder = create_encoder(EncoderExecutor.THREAD)
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_connection(encoder, reader, writer),
+        path=settings.ENCODER_HOST_SOCKET,
+    )
+    # Only processes of the same user may send jobs.
+    os.chmod(settings.ENCODER_HOST_SOCKET, 0o600)
+    logger.info('The encoder host is listening on %s.', settings.ENCODER_HOST_SOCKET)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        encoder.close()
+
+
+def run():
+    # app.server imports this module.
+    from app.server import configure_logging
+
+    configure_logging()
+    asyncio.run(serve())
+
+
+def start() -> BaseProcess:
+    """Start the encoder host and wait until it accepts jobs."""
+    if os.path.exists(settings.ENCODER_HOST_SOCKET):
+        os.remove(settings.ENCODER_HOST_SOCKET)
+
+    process = multiprocessing.get_context('spawn').Process(
+        target=run,
+        name='encoder-host',
+        daemon=True,
+    )
+    process.start()
+
+    deadline = time.monotonic() + settings.ENCODER_HOST_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError(f'The encoder host exited with code {process.exitcode}.')
+        if is_ready():
+            return process
+        time.sleep(0.1)
+
+    process.terminate()
+    raise RuntimeError('The encoder host did not start in time.')
+
+
+def is_ready() -> bool:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(settings.ENCODER_HOST_SOCKET)
+            send_message(sock, {'fn': 'split', 'args': [[], 1, 0]})
+            receive_message(sock)
+    except OSError:
+        return False
+    return True
@@ -1,54 +1,280 @@
+import datetime as dt
 import uuid
+from enum import Enum
 
 from pgvector.sqlalchemy import Vector
-from pydantic import Field
-from sqlalchemy import Column, ForeignKey, Table, types
+from pydantic import Field, model_validator
+from sqlalchemy import Column, Computed, ForeignKey, Index, Table, UniqueConstraint, text, types
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from app.core.cursor import decode_cursor
 from app.core.models import (
     AuditMixin,
     BaseSchema,
     BaseSQLModel,
+    ChangeMixin,
+    DeletedEntity,
     OwnerMixin,
     PrimaryUUIDMixin,
 )
 from app.slices.tag.models import Tag, TagPublic
 
 from .constants import (
+    NOTE_CHANGES_PAGE_SIZE,
+    NOTE_CHANGES_PAGE_SIZE_MAX,
     NOTE_CONTENT_MAX_LENGTH,
     NOTE_NAME_MAX_LENGTH,
     NOTE_NAME_MIN_LENGTH,
     NOTE_PAGE_LIMIT_MAX,
     NOTE_PAGE_SIZE,
+    NOTE_SIMILAR_IDS_MAX_LENGTH,
+    NOTE_SNIPPET_LENGTH_MAX,
+    NOTE_TAG_FILTER_MAX_LENGTH,
     SENTENCE_TRANSFORMERS_EMBEDDING_SIZE,
 )
 
 note_tag_m2m = Table(
     'note_tag_m2m',
     BaseSQLModel.metadata,
-    Column('note_id', ForeignKey('note.id', ondelete='CASCADE')),
-    Column('tag_id', ForeignKey('tag.id', ondelete='CASCADE')),
+    Column('note_id', ForeignKey('note.id', ondelete='CASCADE'), primary_key=True),
+    Column('tag_id', ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True),
+    Index('note_tag_m2m_tag_id_note_id_idx', 'tag_id', 'note_id'),
 )
 
 
-class Note(PrimaryUUIDMixin, AuditMixin, OwnerMixin, BaseSQLModel):
+class Note(PrimaryUUIDMixin, AuditMixin, ChangeMixin, OwnerMixin, BaseSQLModel):
+    __table_args__ = (
+        Index('note_owner_id_created_at_idx', 'owner_id', text('created_at DESC')),
+        Index('note_owner_id_change_xid_idx', 'owner_id', 'change_xid'),
+        Index(
+            'note_embedding_idx',
+            'embedding',
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding': 'vector_cosine_ops'},
+        ),
+        Index('note_search_vector_idx', 'search_vector', postgresql_using='gin'),
+    )
+
     name: Mapped[str] = mapped_column(types.String(NOTE_NAME_MAX_LENGTH), nullable=False)
     content: Mapped[str] = mapped_column(types.String(NOTE_CONTENT_MAX_LENGTH), nullable=False)
-    embedding: Mapped[list[float]] = mapped_column(
+    # The mean of the chunk embeddings. None until the embedding job of a new note is done.
+    embedding: Mapped[list[float] | None] = mapped_column(
         Vector(SENTENCE_TRANSFORMERS_EMBEDDING_SIZE),
-        nullable=False,
+        nullable=True,
+    )
+    # SHA-256 of the text the embedding was computed from.
+    embedding_source_hash: Mapped[str | None] = mapped_column(types.String(64), nullable=True)
+    # For keyword search. The `simple` configuration doesn't stem words, so identifiers
+    # and names in any language are matched as they are.
+    search_vector: Mapped[str] = mapped_column(
+        TSVECTOR,
+        Computed(
+            "setweight(to_tsvector('simple', name), 'A') || "
+            "setweight(to_tsvector('simple', content), 'B')",
+            persisted=True,
+        ),
+        init=False,
+        deferred=True,
+        repr=False,
+        compare=False,
     )
     tags: Mapped[list[Tag]] = relationship(
         secondary=note_tag_m2m,
         lazy='joined',
         default_factory=list,
     )
+    # Chunks are managed by the note service, the relationship is never loaded.
+    chunks: Mapped[list['NoteChunk']] = relationship(
+        lazy='raise',
+        cascade='all, delete-orphan',
+        passive_deletes=True,
+        default_factory=list,
+        repr=False,
+        compare=False,
+    )
+
+
+class NoteChunk(OwnerMixin, BaseSQLModel):
+    """A piece of a note short enough for the model to see it whole."""
+
+    __table_args__ = (
+        Index('note_chunk_owner_id_text_hash_idx', 'owner_id', 'text_hash'),
+        Index(
+            'note_chunk_embedding_idx',
+            'embedding',
+            postgresql_using='hnsw',
+            postgresql_with={'m': 16, 'ef_construction': 64},
+            postgresql_ops={'embedding': 'vector_cosine_ops'},
+        ),
+    )
+
+    note_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey('note.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+    position: Mapped[int] = mapped_column(types.Integer, primary_key=True)
+    # SHA-256 of the chunk text.
+    text_hash: Mapped[str] = mapped_column(types.String(64), nullable=False)
+    embedding: Mapped[list[float]] = mapped_column(
+        Vector(SENTENCE_TRANSFORMERS_EMBEDDING_SIZE),
+        nullable=False,
+    )
+
 
+class NoteEmbeddingJob(PrimaryUUIDMixin, BaseSQLModel):
+    """
+    The text of the note has to be embedded. Jobs are added in the transaction that changes
+    the note and are done by the embed worker.
+    """
+
+    __table_args__ = (
+        Index('note_embedding_job_created_at_idx', 'created_at'),
+        # One pending job per note, the worker embeds the text the note has by then.
+        UniqueConstraint('note_id', name='note_embedding_job_note_id_key'),
+    )
 
-class NotesRead(BaseSchema):
+    note_id: Mapped[uuid.UUID] = mapped_column(
+        ForeignKey('note.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+    created_at: Mapped[dt.datetime] = mapped_column(
+        types.DateTime(timezone=True),
+        default_factory=lambda: dt.datetime.now(dt.timezone.utc),
+        nullable=False,
+        kw_only=True,
+    )
+    # When a worker took the job. Jobs of a worker that died are taken again once the claim
+    # is older than EMBED_WORKER_CLAIM_TIMEOUT.
+    claimed_at: Mapped[dt.datetime | None] = mapped_column(
+        types.DateTime(timezone=True),
+        nullable=True,
+        default=None,
+        kw_only=True,
+    )
+
+
+class SearchMode(str, Enum):
+    SEMANTIC = 'semantic'
+    KEYWORD = 'keyword'
+    # Semantic and keyword results merged by reciprocal rank fusion.
+    HYBRID = 'hybrid'
+
+
+class NoteField(str, Enum):
+    NAME = 'name'
+    CONTENT = 'content'
+    TAGS = 'tags'
+
+
+class NoteTagFilter(BaseSchema):
+    """Notes having all of `tags`, at least one of `any_tags` and none of `exclude_tags`."""
+
+    tags: list[str] = Field(default_factory=list, max_length=NOTE_TAG_FILTER_MAX_LENGTH)
+    any_tags: list[str] = Field(default_factory=list, max_length=NOTE_TAG_FILTER_MAX_LENGTH)
+    exclude_tags: list[str] = Field(default_factory=list, max_length=NOTE_TAG_FILTER_MAX_LENGTH)
+
+
+class NotesRead(NoteTagFilter):
     q: str | None = Field(default=None)
+    mode: SearchMode = Field(default=SearchMode.SEMANTIC)
+    cursor: str | None = Field(default=None)
     offset: int = Field(default=0, ge=0, le=NOTE_PAGE_LIMIT_MAX)
     limit: int = Field(default=NOTE_PAGE_SIZE, ge=0)
+    # Fields of the notes to return besides `id`.
+    fields: list[NoteField] = Field(default_factory=lambda: list(NoteField))
+    # Return at most this many characters of the content as `snippet`, around the matched
+    # words for keyword and hybrid search.
+    snippet_length: int | None = Field(default=None, ge=1, le=NOTE_SNIPPET_LENGTH_MAX)
+
+    @model_validator(mode='after')
+    def check_limit(self):
+        # Semantic and hybrid search scan more candidates for a larger page, listing doesn't.
+        if self.q and self.limit > NOTE_PAGE_LIMIT_MAX:
+            raise ValueError(f'The limit of a search is at most {NOTE_PAGE_LIMIT_MAX}.')
+
+        return self
+
+    @model_validator(mode='after')
+    def check_cursor(self):
+        if self.cursor is None:
+            return self
+
+        if self.offset:
+            raise ValueError('Use either a cursor or an offset, not both.')
+
+        if self.q and self.mode == SearchMode.HYBRID:
+            raise ValueError('Hybrid search results are paged by an offset only.')
+
+        values = parse_note_cursor(self.cursor)
+        if not self.q:
+            key = 'created_at'
+        elif self.mode == SearchMode.SEMANTIC:
+            key = 'distance'
+        else:
+            key = 'rank'
+        if key not in values:
+            raise ValueError('The cursor belongs to another query.')
+
+        return self
+
+
+def parse_note_cursor(cursor: str) -> dict:
+    """
+    A cursor points at the last note of a page: `(created_at, id)` for listing,
+    `(distance, id)` for semantic search, `(rank, id)` for keyword search.
+    """
+    values = decode_cursor(cursor)
+    try:
+        parsed = {'id': uuid.UUID(values['id'])}
+        if 'distance' in values:
+            parsed['distance'] = float(values['distance'])
+        elif 'rank' in values:
+            parsed['rank'] = float(values['rank'])
+        else:
+            parsed['created_at'] = dt.datetime.fromisoformat(values['created_at'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor.') from e
+
+    return parsed
+
+
+class SimilarNotesRead(NoteTagFilter):
+    limit: int = Field(default=NOTE_PAGE_SIZE, ge=0, le=NOTE_PAGE_LIMIT_MAX)
+
+
+class SimilarNotesBatchRead(SimilarNotesRead):
+    ids: list[uuid.UUID] = Field(min_length=1, max_length=NOTE_SIMILAR_IDS_MAX_LENGTH)
+
+
+class NotesExportRead(BaseSchema):
+    tags: bool = Field(default=False)
+    embeddings: bool = Field(default=False)
+
+
+class NoteChangesRead(BaseSchema):
+    # A token of the previous response, none to get all notes and tags.
+    since: str | None = Field(default=None)
+    limit: int = Field(default=NOTE_CHANGES_PAGE_SIZE, ge=1, le=NOTE_CHANGES_PAGE_SIZE_MAX)
+
+    @model_validator(mode='after')
+    def check_since(self):
+        if self.since is not None:
+            parse_changes_token(self.since)
+        return self
+
+
+def parse_changes_token(token: str) -> dict:
+    """A changes token points at the last change a client has: `(change_xid, id)`."""
+    values = decode_cursor(token)
+    try:
+        return {
+            'change_xid': int(values['change_xid']),
+            'id': uuid.UUID(values['id']),
+        }
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('Invalid token.') from e
 
 
 class NoteCreate(BaseSchema):
@@ -57,6 +283,18 @@ class NoteCreate(BaseSchema):
     tags: list[str] = Field(default_factory=list)
 
 
+class NoteBulkError(BaseSchema):
+    # The position of the note in the request.
+    index: int
+    detail: str
+
+
+class NotesBulkPublic(BaseSchema):
+    # IDs of the created notes in the order of the request, None for notes with errors.
+    ids: list[uuid.UUID | None]
+    errors: list[NoteBulkError]
+
+
 class NoteUpdate(BaseSchema):
     name: str | None = Field(default=None)
     content: str | None = Field(default=None)
@@ -68,3 +306,43 @@ class NotePublic(BaseSchema):
     name: str
     content: str
     tags: list[TagPublic]
+
+
+class NotePartialPublic(BaseSchema):
+    """A note of a list with only the requested fields set."""
+
+    id: uuid.UUID
+    name: str | None = None
+    content: str | None = None
+    snippet: str | None = None
+    tags: list[TagPublic] | None = None
+
+
+class SimilarNotesPublic(BaseSchema):
+    id: uuid.UUID
+    notes: list[NotePublic]
+
+
+class NoteExportPublic(BaseSchema):
+    id: uuid.UUID
+    name: str
+    content: str
+    created_at: dt.datetime
+    updated_at: dt.datetime
+    tags: list[TagPublic] | None = None
+    embedding: list[float] | None = None
+
+
+class DeletedPublic(BaseSchema):
+    entity: DeletedEntity
+    id: uuid.UUID
+
+
+class NoteChangesPublic(BaseSchema):
+    notes: list[NotePublic]
+    tags: list[TagPublic]
+    deleted: list[DeletedPublic]
+    # Pass it as `since` to get the next changes.
+    next_token: str
+    # There are more changes right away.
+    has_more: bool
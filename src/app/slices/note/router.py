@@ -1,39 +1,188 @@
+import json
 import uuid
+from collections.abc import Sequence
 from typing import Annotated
 
-from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import delete, select
+from sqlalchemy.orm import raiseload
+from sqlalchemy.orm.interfaces import ORMOption
 
-from app.core.db import SessionDep
-from app.core.response import generate_openapi_error_responses
+from app.core.db import ReadOnlySessionDep, SessionDep, SessionFactoryDep, run_transaction
+from app.core.events import EventAction, notify, stream_events
+from app.core.models import DeletedEntity, DeletionLog
+from app.core.response import create_json_response, generate_openapi_error_responses
 from app.core.security import CurrentUserIDDep
 from app.slices.tag.service import get_or_create_tags
 
-from .models import Note, NoteCreate, NotePublic, NotesRead, NoteUpdate
-from .service import create, search_notes, update
+from .constants import NEXT_CURSOR_HEADER, NOTE_BULK_MAX_SIZE
+from .models import (
+    Note,
+    NoteBulkError,
+    NoteChangesPublic,
+    NoteChangesRead,
+    NoteCreate,
+    NotePartialPublic,
+    NotePublic,
+    NotesBulkPublic,
+    NotesExportRead,
+    NotesRead,
+    NoteUpdate,
+    SimilarNotesBatchRead,
+    SimilarNotesPublic,
+    SimilarNotesRead,
+)
+from .service import (
+    create,
+    create_many,
+    embed_sources,
+    export_notes,
+    get_changes,
+    get_embedding_source,
+    get_similar_notes,
+    get_text_hash,
+    search_notes,
+    update,
+)
 
 router = APIRouter()
 
+NOTES_ADAPTER = TypeAdapter(list[NotePartialPublic])
+SIMILAR_NOTES_ADAPTER = TypeAdapter(list[NotePublic])
+SIMILAR_NOTES_BATCH_ADAPTER = TypeAdapter(list[SimilarNotesPublic])
+
+
+# Registered before `/{id}`, otherwise `events` would be taken for a note id.
+@router.get(
+    '/events',
+    response_class=StreamingResponse,
+    responses={200: {'content': {'text/event-stream': {}}}},
+)
+async def read_events(*, request: Request, current_user_id: CurrentUserIDDep):
+    """
+    Changes of the user's notes and tags as server-sent events: `note.created`, `tag.deleted`
+    etc. with the ID. Sync changes on `resync` and when reconnecting.
+    """
+    broker = request.state.event_broker
+    # Fail here rather than after the response has started.
+    await broker.start()
+    return StreamingResponse(
+        stream_events(broker, current_user_id),
+        media_type='text/event-stream',
+        # Proxies must pass events through right away.
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+# Registered before `/{id}`, otherwise `changes` would be taken for a note id.
+@router.get('/changes', response_model=NoteChangesPublic)
+async def read_changes(
+    *,
+    session: ReadOnlySessionDep,
+    current_user_id: CurrentUserIDDep,
+    params: Annotated[NoteChangesRead, Query()],
+):
+    """Notes and tags changed or deleted since the last sync, for clients keeping a copy."""
+    changes = await get_changes(session, current_user_id, params)
+    return NoteChangesPublic.model_validate(changes)
+
+
+# Registered before `/{id}`, otherwise `export` would be taken for a note id.
+@router.get(
+    '/export',
+    response_class=StreamingResponse,
+    responses={200: {'content': {'application/x-ndjson': {}}}},
+)
+async def export_user_notes(
+    *,
+    session_factory: SessionFactoryDep,
+    current_user_id: CurrentUserIDDep,
+    params: Annotated[NotesExportRead, Query()],
+):
+    """All notes of the user, one JSON object per line."""
+
+    async def stream():
+        async with session_factory() as session:
+            async for chunk in export_notes(session, current_user_id, params):
+                yield chunk
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+# Registered before `/{id}`, otherwise `similar` would be taken for a note id.
+@router.get(
+    '/similar',
+    response_model=list[SimilarNotesPublic],
+    responses=generate_openapi_error_responses({403, 404}),
+)
+async def read_similar_notes_batch(
+    *,
+    session: ReadOnlySessionDep,
+    current_user_id: CurrentUserIDDep,
+    params: Annotated[SimilarNotesBatchRead, Query()],
+) -> Response:
+    note_ids = list(dict.fromkeys(params.ids))
+    await check_owner_or_40x(session, current_user_id, note_ids)
+    note_id_to_similar = await get_similar_notes(session, current_user_id, note_ids, params)
+    data = [{'id': x, 'notes': note_id_to_similar[x]} for x in note_ids]
+    return create_json_response(SIMILAR_NOTES_BATCH_ADAPTER, data, 'read_similar_notes_batch')
+
 
 @router.get(
     '/{id}',
     response_model=NotePublic,
     responses=generate_openapi_error_responses({403, 404}),
 )
-async def read_note(id: uuid.UUID, session: SessionDep, current_user_id: CurrentUserIDDep):
+async def read_note(id: uuid.UUID, session: ReadOnlySessionDep, current_user_id: CurrentUserIDDep):
     note = await get_or_40x(session, current_user_id, id)
     return NotePublic.model_validate(note)
 
 
-@router.get('/')
+@router.get(
+    '/{id}/similar',
+    response_model=list[NotePublic],
+    responses=generate_openapi_error_responses({403, 404}),
+)
+async def read_similar_notes(
+    *,
+    session: ReadOnlySessionDep,
+    current_user_id: CurrentUserIDDep,
+    id: uuid.UUID,
+    params: Annotated[SimilarNotesRead, Query()],
+) -> Response:
+    await check_owner_or_40x(session, current_user_id, [id])
+    note_id_to_similar = await get_similar_notes(session, current_user_id, [id], params)
+    return create_json_response(SIMILAR_NOTES_ADAPTER, note_id_to_similar[id], 'read_similar_notes')
+
+
+@router.get(
+    '/',
+    response_model=list[NotePartialPublic],
+    responses={
+        200: {
+            'headers': {
+                NEXT_CURSOR_HEADER: {
+                    'description': 'Pass it as `cursor` to get the next page.',
+                    'schema': {'type': 'string'},
+                },
+            },
+        },
+    },
+)
 async def read_notes(
     *,
     request: Request,
-    session: SessionDep,
+    session: ReadOnlySessionDep,
     current_user_id: CurrentUserIDDep,
     params: Annotated[NotesRead, Query()],
-) -> list[NotePublic]:
-    st = request.state.st
-    return await search_notes(session, current_user_id, st, params.q, params.offset, params.limit)
+) -> Response:
+    encoder = request.state.encoder
+    notes, next_cursor = await search_notes(session, current_user_id, encoder, params)
+    headers = {NEXT_CURSOR_HEADER: next_cursor} if next_cursor else None
+    # Fields not requested are left out.
+    return create_json_response(NOTES_ADAPTER, notes, 'read_notes', headers, exclude_unset=True)
 
 
 @router.post('/', response_model=NotePublic)
@@ -44,20 +193,104 @@ async def create_note(
     current_user_id: CurrentUserIDDep,
     note_in: NoteCreate,
 ):
-    st = request.state.st
-    tags = await get_or_create_tags(session, current_user_id, note_in.tags)
-    note = create(
-        session,
-        st,
-        name=note_in.name,
-        content=note_in.content,
-        tags=tags,
-        owner_id=current_user_id,
-    )
-    await session.commit()
+    encoder = request.state.encoder
+    # Before the transaction, a retry of it doesn't run the model again.
+    source = get_embedding_source(note_in.name, note_in.content)
+    embedded_sources = await embed_sources(session, encoder, current_user_id, [source])
+
+    async def work():
+        tags = await get_or_create_tags(session, current_user_id, note_in.tags)
+        note = await create(
+            session,
+            encoder,
+            embedded_sources,
+            name=note_in.name,
+            content=note_in.content,
+            tags=tags,
+            owner_id=current_user_id,
+        )
+        await notify(session, current_user_id, 'note', EventAction.CREATED, [note.id])
+        return note
+
+    note = await run_transaction(session, work)
     return NotePublic.model_validate(note)
 
 
+@router.post(
+    '/bulk',
+    response_model=NotesBulkPublic,
+    responses={413: {'description': 'Too many notes'}},
+    openapi_extra={
+        'requestBody': {
+            'required': True,
+            'description': 'A JSON array of notes or one note per line (NDJSON).',
+            'content': {
+                'application/json': {
+                    'schema': {
+                        'type': 'array',
+                        'items': {'$ref': '#/components/schemas/NoteCreate'},
+                    },
+                },
+                'application/x-ndjson': {'schema': {'type': 'string'}},
+            },
+        },
+    },
+)
+async def create_notes_bulk(
+    *,
+    request: Request,
+    session: SessionDep,
+    current_user_id: CurrentUserIDDep,
+):
+    """Create many notes at once. Invalid notes are reported and the rest are created."""
+    body = await request.body()
+    is_ndjson = request.headers.get('content-type', '').startswith('application/x-ndjson')
+    items = parse_bulk_body(body, is_ndjson)
+    if len(items) > NOTE_BULK_MAX_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f'Up to {NOTE_BULK_MAX_SIZE} notes can be imported at once.',
+        )
+
+    notes_in = []
+    indexes = []
+    errors = []
+    for index, item in enumerate(items):
+        if isinstance(item, ValueError):
+            errors.append(NoteBulkError(index=index, detail=str(item)))
+            continue
+
+        try:
+            notes_in.append(NoteCreate.model_validate(item))
+        except ValidationError as e:
+            detail = '; '.join(
+                f'{".".join(map(str, x["loc"])) or "note"}: {x["msg"]}' for x in e.errors()
+            )
+            errors.append(NoteBulkError(index=index, detail=detail))
+        else:
+            indexes.append(index)
+
+    ids = [None] * len(items)
+    if notes_in:
+        encoder = request.state.encoder
+        # Before the transaction, a retry of it doesn't run the model again.
+        sources = [get_embedding_source(x.name, x.content) for x in notes_in]
+        embedded_sources = await embed_sources(session, encoder, current_user_id, sources)
+
+        async def work():
+            note_ids = await create_many(
+                session, encoder, current_user_id, notes_in, embedded_sources
+            )
+            await notify(session, current_user_id, 'note', EventAction.CREATED, note_ids)
+            return note_ids
+
+        note_ids = await run_transaction(session, work)
+        for index, note_id in zip(indexes, note_ids):
+            ids[index] = note_id
+
+    return NotesBulkPublic(ids=ids, errors=errors)
+
+
 @router.patch(
     '/{id}',
     status_code=204,
@@ -71,16 +304,38 @@ async def update_note(
     id: uuid.UUID,
     note_in: NoteUpdate,
 ):
-    note = await get_or_40x(session, current_user_id, id)
+    note = await get_or_40x(session, current_user_id, id, (raiseload(Note.tags),))
     update_data = note_in.model_dump(exclude_unset=True)
+    if not update_data:
+        return
+
+    encoder = request.state.encoder
+    embedded_sources = {}
+    if 'name' in update_data or 'content' in update_data:
+        # Before the transaction, a retry of it doesn't run the model again.
+        source = get_embedding_source(
+            update_data.get('name', note.name),
+            update_data.get('content', note.content),
+        )
+        if get_text_hash(source) != note.embedding_source_hash:
+            # End the read, so that no transaction is open while the model runs.
+            await session.commit()
+            embedded_sources = await embed_sources(session, encoder, current_user_id, [source])
 
-    if 'tags' in update_data:
-        update_data['tags'] = await get_or_create_tags(session, note.owner_id, update_data['tags'])
+    async def work():
+        kwargs = dict(update_data)
+        if 'tags' in kwargs:
+            # Before the note is read, so that the snapshot of the transaction has new tags.
+            kwargs['tags'] = await get_or_create_tags(session, current_user_id, kwargs['tags'])
 
-    if update_data:
-        st = request.state.st
-        update(st, note, **update_data)
-        await session.commit()
+        # The note read before the transaction may be out of date. The tags are needed only
+        # to replace them.
+        options = () if 'tags' in kwargs else (raiseload(Note.tags),)
+        note = await get_or_40x(session, current_user_id, id, options, populate_existing=True)
+        await update(session, encoder, note, embedded_sources, **kwargs)
+        await notify(session, current_user_id, 'note', EventAction.UPDATED, [note.id])
+
+    await run_transaction(session, work)
 
 
 @router.delete(
@@ -89,13 +344,43 @@ async def update_note(
     responses=generate_openapi_error_responses({403, 404}),
 )
 async def delete_note(*, session: SessionDep, current_user_id: CurrentUserIDDep, id: uuid.UUID):
-    note = await get_or_40x(session, current_user_id, id)
-    await session.delete(note)
-    await session.commit()
+    async def work():
+        # Chunks, tag links and embedding jobs are deleted by the database cascades, there is
+        # no need to load the note.
+        result = await session.execute(
+            delete(Note)
+            .where(Note.id == id)
+            .where(Note.owner_id == current_user_id)
+            .returning(Note.id)
+            .execution_options(query_name='note_delete')
+        )
+        if result.scalar_one_or_none() is None:
+            await check_owner_or_40x(session, current_user_id, [id])
 
+        session.add(DeletionLog(entity=DeletedEntity.NOTE, entity_id=id, owner_id=current_user_id))
+        await notify(session, current_user_id, 'note', EventAction.DELETED, [id])
 
-async def get_or_40x(session: SessionDep, current_user_id: CurrentUserIDDep, id: uuid.UUID):
-    note = await session.get(Note, id)
+    await run_transaction(session, work)
+
+
+async def get_or_40x(
+    session: SessionDep,
+    current_user_id: CurrentUserIDDep,
+    id: uuid.UUID,
+    options: Sequence[ORMOption] = (),
+    populate_existing: bool = False,
+):
+    """
+    Options pick the loader strategies, they are ignored if the note is already loaded
+    unless `populate_existing` loads it again.
+    """
+    note = await session.get(
+        Note,
+        id,
+        options=options,
+        populate_existing=populate_existing,
+        execution_options={'query_name': 'note_get'},
+    )
     if not note:
         raise HTTPException(status_code=404, detail=f'Note {id} was not found.')
 
@@ -106,3 +391,49 @@ async def get_or_40x(session: SessionDep, current_user_id: CurrentUserIDDep, id:
         )
 
     return note
+
+
+async def check_owner_or_40x(
+    session: SessionDep,
+    current_user_id: CurrentUserIDDep,
+    ids: list[uuid.UUID],
+):
+    """Like `get_or_40x` for several notes, without loading them."""
+    result = await session.execute(
+        select(Note.id, Note.owner_id)
+        .where(Note.id.in_(ids))
+        .execution_options(query_name='note_owners')
+    )
+    id_to_owner_id = dict(result.all())
+
+    for id in ids:
+        if id not in id_to_owner_id:
+            raise HTTPException(status_code=404, detail=f'Note {id} was not found.')
+
+        if id_to_owner_id[id] != current_user_id:
+            raise HTTPException(
+                status_code=403,
+                detail='You have access only to your notes. This one is not yours.',
+            )
+
+
+def parse_bulk_body(body: bytes, is_ndjson: bool) -> list:
+    """Items of a bulk request. A line of NDJSON that is not JSON becomes a ValueError item."""
+    if not is_ndjson:
+        try:
+            items = json.loads(body)
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail='The body is not valid JSON.') from e
+        if not isinstance(items, list):
+            raise HTTPException(status_code=422, detail='The body has to be a JSON array.')
+        return items
+
+    items = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(ValueError('The line is not valid JSON.'))
+    return items
@@ -1,78 +1,1032 @@
+import datetime as dt
+import hashlib
+import itertools
 import uuid
 from collections import defaultdict
+from collections.abc import AsyncGenerator
 
-from sentence_transformers import SentenceTransformer
-from sqlalchemy import select
+import numpy as np
+from sqlalchemy import (
+    and_,
+    delete,
+    func,
+    literal,
+    literal_column,
+    or_,
+    select,
+    true,
+    tuple_,
+    union_all,
+)
+from sqlalchemy import update as update_statement
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, lazyload, load_only
 
-from .models import Note, Tag, note_tag_m2m
+from app.core.config import EmbeddingMode, settings
+from app.core.cursor import encode_cursor
+from app.core.models import DeletedEntity, DeletionLog
+from app.slices.tag.service import get_or_create_tags
 
+from .constants import (
+    NOTE_BULK_EMBED_BATCH_SIZE,
+    NOTE_CHUNK_OVERLAP,
+    NOTE_CHUNK_SIZE,
+    NOTE_EXPORT_BATCH_SIZE,
+    NOTE_SEARCH_CHUNK_OVERFETCH,
+    NOTE_SEARCH_HYBRID_CANDIDATE_COUNT,
+    NOTE_SEARCH_MIN_SCORE,
+    NOTE_SEARCH_RRF_K,
+    NOTE_SNIPPET_CHARS_PER_WORD,
+)
+from .encoder import Encoder
+from .models import (
+    Note,
+    NoteChangesRead,
+    NoteChunk,
+    NoteCreate,
+    NoteEmbeddingJob,
+    NoteExportPublic,
+    NoteField,
+    NotesExportRead,
+    NotesRead,
+    NoteTagFilter,
+    SearchMode,
+    SimilarNotesRead,
+    Tag,
+    note_tag_m2m,
+    parse_changes_token,
+    parse_note_cursor,
+)
 
-def get_embedding(st: SentenceTransformer, name: str, content: str):
-    source = '. '.join(filter(None, (name, content)))
-    return st.encode(source).tolist()
+# Chunk text hashes and embeddings of source texts by the hash of the source text.
+EmbeddedSources = dict[str, list[tuple[str, list[float]]]]
 
 
-def create(session: AsyncSession, st: SentenceTransformer, **kwargs):
-    if 'embedding' not in kwargs:
-        kwargs['embedding'] = get_embedding(st, kwargs['name'], kwargs['content'])
+def get_embedding_source(name: str, content: str) -> str:
+    return '. '.join(filter(None, (name, content)))
 
-    note = Note(**kwargs)
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+async def get_embedding(encoder: Encoder, name: str, content: str) -> list[float]:
+    [embedding] = await encoder.encode([get_embedding_source(name, content)])
+    return embedding
+
+
+def get_note_embedding(chunk_embeddings: list[list[float]]) -> list[float]:
+    """The mean of the chunk embeddings, normalized as the model output is."""
+    if len(chunk_embeddings) == 1:
+        return chunk_embeddings[0]
+
+    mean = np.mean(chunk_embeddings, axis=0)
+    return (mean / np.linalg.norm(mean)).tolist()
+
+
+async def embed_chunks(
+    session: AsyncSession,
+    encoder: Encoder,
+    sources: list[tuple[uuid.UUID, str, list[NoteChunk]]],
+) -> list[list[tuple[str, list[float]]]]:
+    """
+    Split source texts into chunks and return a text hash and an embedding of each chunk.
+
+    A source is an owner ID, a text and the current chunks of the note. The texts are split
+    by one job. Only chunks not found among the current ones and other chunks of the owner
+    go to the model, all in one call.
+    """
+    texts = await encoder.split([x for _, x, _ in sources], NOTE_CHUNK_SIZE, NOTE_CHUNK_OVERLAP)
+    hashes = [[get_text_hash(x) for x in source_texts] for source_texts in texts]
+
+    key_to_embedding = {
+        (owner_id, x.text_hash): x.embedding for owner_id, _, chunks in sources for x in chunks
+    }
+
+    missing_keys = {
+        (owner_id, x)
+        for (owner_id, _, _), source_hashes in zip(sources, hashes)
+        for x in source_hashes
+    } - key_to_embedding.keys()
+    if missing_keys:
+        query = (
+            select(NoteChunk.owner_id, NoteChunk.text_hash, NoteChunk.embedding)
+            .where(tuple_(NoteChunk.owner_id, NoteChunk.text_hash).in_(missing_keys))
+            .distinct(NoteChunk.owner_id, NoteChunk.text_hash)
+            .execution_options(query_name='note_chunk_by_text_hash')
+        )
+        # A connection of its own, closed before the model runs, so that no transaction of the
+        # session is started or kept open by the lookup. Only committed chunks are reused.
+        async with session.bind.connect() as connection:
+            result = await connection.execute(query)
+            key_to_embedding.update(((owner_id, x), y) for owner_id, x, y in result)
+
+    missing_keys -= key_to_embedding.keys()
+    if missing_keys:
+        # The same text of different owners is embedded once.
+        hash_to_text = {
+            text_hash: text
+            for (owner_id, _, _), source_texts, source_hashes in zip(sources, texts, hashes)
+            for text, text_hash in zip(source_texts, source_hashes)
+            if (owner_id, text_hash) in missing_keys
+        }
+        embeddings = await encoder.encode(list(hash_to_text.values()))
+        hash_to_embedding = dict(zip(hash_to_text, embeddings))
+        key_to_embedding.update((x, hash_to_embedding[x[1]]) for x in missing_keys)
+
+    return [
+        [(x, key_to_embedding[(owner_id, x)]) for x in source_hashes]
+        for (owner_id, _, _), source_hashes in zip(sources, hashes)
+    ]
+
+
+async def save_chunks(
+    session: AsyncSession,
+    note: Note,
+    chunks: list[NoteChunk],
+    embedded_chunks: list[tuple[str, list[float]]],
+):
+    """Bring the current chunks of the note in line with the embedded ones."""
+    position_to_chunk = {x.position: x for x in chunks}
+
+    for position, (text_hash, embedding) in enumerate(embedded_chunks):
+        chunk = position_to_chunk.pop(position, None)
+        if chunk is None:
+            chunk = NoteChunk(
+                note_id=note.id,
+                position=position,
+                owner_id=note.owner_id,
+                text_hash=text_hash,
+                embedding=embedding,
+            )
+            session.add(chunk)
+        elif chunk.text_hash != text_hash:
+            chunk.text_hash = text_hash
+            chunk.embedding = embedding
+
+    for chunk in position_to_chunk.values():
+        await session.delete(chunk)
+
+
+async def embed_sources(
+    session: AsyncSession,
+    encoder: Encoder,
+    owner_id: uuid.UUID,
+    sources: list[str],
+    embedded_sources: EmbeddedSources | None = None,
+) -> EmbeddedSources:
+    """
+    Embed the chunks of the source texts missing in `embedded_sources` and add them to it.
+    Called before the write transaction, so that a retry of it doesn't run the model again,
+    and with no transaction of the session open, so that no connection waits for the model.
+    Nothing is embedded in async embedding mode.
+    """
+    if embedded_sources is None:
+        embedded_sources = {}
+    if settings.EMBEDDING_MODE == EmbeddingMode.ASYNC:
+        return embedded_sources
+
+    hash_to_source = {get_text_hash(x): x for x in sources}
+    missing = [(x, y) for x, y in hash_to_source.items() if x not in embedded_sources]
+    for batch in itertools.batched(missing, NOTE_BULK_EMBED_BATCH_SIZE):
+        all_embedded_chunks = await embed_chunks(
+            session, encoder, [(owner_id, source, []) for _, source in batch]
+        )
+        embedded_sources.update(zip((x for x, _ in batch), all_embedded_chunks))
+
+    return embedded_sources
+
+
+async def create(
+    session: AsyncSession,
+    encoder: Encoder,
+    embedded_sources: EmbeddedSources | None = None,
+    **kwargs,
+):
+    if settings.EMBEDDING_MODE == EmbeddingMode.ASYNC:
+        note = Note(embedding=None, embedding_source_hash=None, **kwargs)
+        session.add(note)
+        session.add(NoteEmbeddingJob(note_id=note.id))
+        return note
+
+    source = get_embedding_source(kwargs['name'], kwargs['content'])
+    source_hash = get_text_hash(source)
+    embedded_sources = await embed_sources(
+        session, encoder, kwargs['owner_id'], [source], embedded_sources
+    )
+    embedded_chunks = embedded_sources[source_hash]
+
+    note = Note(
+        embedding=get_note_embedding([x[1] for x in embedded_chunks]),
+        embedding_source_hash=source_hash,
+        **kwargs,
+    )
     session.add(note)
+    await save_chunks(session, note, [], embedded_chunks)
     return note
 
 
-def update(st: SentenceTransformer, note: Note, **kwargs):
+async def create_many(
+    session: AsyncSession,
+    encoder: Encoder,
+    owner_id: uuid.UUID,
+    notes_in: list[NoteCreate],
+    embedded_sources: EmbeddedSources | None = None,
+) -> list[uuid.UUID]:
+    """
+    Create notes for an import and return their IDs. Tags are resolved at once, texts are
+    embedded by large batches and rows are inserted by multi-row INSERTs, skipping the ORM
+    unit of work.
+    """
+    tag_names = list(dict.fromkeys(x for note_in in notes_in for x in note_in.tags))
+    tags = await get_or_create_tags(session, owner_id, tag_names)
+    tag_name_to_id = {x.name: x.id for x in tags}
+
+    now = dt.datetime.now(dt.timezone.utc)
+    note_rows = []
+    chunk_rows = []
+    tag_rows = []
+    job_rows = []
+    sources = [get_embedding_source(x.name, x.content) for x in notes_in]
+    embedded_sources = await embed_sources(session, encoder, owner_id, sources, embedded_sources)
+    for note_in, source in zip(notes_in, sources):
+        note_id = uuid.uuid4()
+        note_row = {
+            'id': note_id,
+            'owner_id': owner_id,
+            'name': note_in.name,
+            'content': note_in.content,
+            'embedding': None,
+            'embedding_source_hash': None,
+            'created_at': now,
+            'updated_at': now,
+        }
+        source_hash = get_text_hash(source)
+        if settings.EMBEDDING_MODE == EmbeddingMode.ASYNC:
+            job_rows.append({'id': uuid.uuid4(), 'note_id': note_id, 'created_at': now})
+        else:
+            embedded_chunks = embedded_sources[source_hash]
+            note_row['embedding'] = get_note_embedding([x[1] for x in embedded_chunks])
+            note_row['embedding_source_hash'] = source_hash
+            chunk_rows.extend(
+                {
+                    'note_id': note_id,
+                    'position': position,
+                    'owner_id': owner_id,
+                    'text_hash': text_hash,
+                    'embedding': embedding,
+                }
+                for position, (text_hash, embedding) in enumerate(embedded_chunks)
+            )
+        note_rows.append(note_row)
+        # A tag deleted by a concurrent transaction is left out.
+        tag_rows.extend(
+            {'note_id': note_id, 'tag_id': tag_name_to_id[x]}
+            for x in set(note_in.tags)
+            if x in tag_name_to_id
+        )
+
+    for table, rows in (
+        (Note, note_rows),
+        (NoteChunk, chunk_rows),
+        (note_tag_m2m, tag_rows),
+        (NoteEmbeddingJob, job_rows),
+    ):
+        if rows:
+            await session.execute(insert(table), rows)
+
+    return [x['id'] for x in note_rows]
+
+
+async def update(
+    session: AsyncSession,
+    encoder: Encoder,
+    note: Note,
+    embedded_sources: EmbeddedSources | None = None,
+    **kwargs,
+):
+    add_embedding_job = False
+    if 'name' in kwargs or 'content' in kwargs:
+        source = get_embedding_source(
+            kwargs.get('name', note.name),
+            kwargs.get('content', note.content),
+        )
+        source_hash = get_text_hash(source)
+
+        # Clients often send the whole note back, don't pay for inference if the text is the same.
+        if source_hash != note.embedding_source_hash:
+            if settings.EMBEDDING_MODE == EmbeddingMode.ASYNC:
+                # The old embedding keeps the note searchable until the job is done.
+                add_embedding_job = True
+            else:
+                result = await session.scalars(
+                    select(NoteChunk)
+                    .where(NoteChunk.note_id == note.id)
+                    .execution_options(query_name='note_chunks')
+                )
+                chunks = result.all()
+
+                # Embedded before the transaction unless the text was changed concurrently.
+                embedded_sources = await embed_sources(
+                    session, encoder, note.owner_id, [source], embedded_sources
+                )
+                embedded_chunks = embedded_sources[source_hash]
+                await save_chunks(session, note, chunks, embedded_chunks)
+
+                kwargs['embedding'] = get_note_embedding([x[1] for x in embedded_chunks])
+                kwargs['embedding_source_hash'] = source_hash
+
+    if 'tags' in kwargs and {x.id for x in kwargs['tags']} != {x.id for x in note.tags}:
+        # Links are rows of another table, the note row wouldn't change by itself. Clients
+        # syncing changes have to see the note anyway.
+        kwargs['updated_at'] = dt.datetime.now(dt.timezone.utc)
+
     for column, value in kwargs.items():
         setattr(note, column, value)
 
-    if 'name' in kwargs or 'content' in kwargs:
-        note.embedding = get_embedding(st, note.name, note.content)
+    if add_embedding_job:
+        # The note row is updated first. Its lock makes the edit wait for the embed worker
+        # that has taken the pending job, so the job is never skipped while the worker
+        # embeds the old text and then deletes the job.
+        await session.flush()
+        await session.execute(
+            insert(NoteEmbeddingJob)
+            .values(id=uuid.uuid4(), note_id=note.id, created_at=dt.datetime.now(dt.timezone.utc))
+            .on_conflict_do_nothing(constraint='note_embedding_job_note_id_key')
+            .execution_options(query_name='note_embedding_job_add')
+        )
+
+
+async def embed_pending_notes(session: AsyncSession, encoder: Encoder, limit: int) -> int:
+    """
+    Embed notes of up to `limit` oldest jobs and delete the jobs. Return the number of jobs done.
+
+    Runs transactions of its own and none while the model runs, so that edits of the notes
+    don't wait for the model and the changes feed isn't held back. The jobs are claimed first,
+    so several workers can drain the queue at once. Embeddings are saved only if the text
+    of the note is still the embedded one, jobs of notes changed meanwhile are released.
+    """
+    if session.in_transaction():
+        await session.commit()
+
+    # A note edited meanwhile keeps its job, there is no need to fail on a serialization error.
+    await session.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+    claim_timeout = dt.timedelta(seconds=settings.EMBED_WORKER_CLAIM_TIMEOUT)
+    job_id_query = (
+        select(NoteEmbeddingJob.id)
+        .where(
+            or_(
+                NoteEmbeddingJob.claimed_at.is_(None),
+                NoteEmbeddingJob.claimed_at < func.now() - claim_timeout,
+            )
+        )
+        .order_by(NoteEmbeddingJob.created_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    result = await session.execute(
+        update_statement(NoteEmbeddingJob)
+        .where(NoteEmbeddingJob.id.in_(job_id_query))
+        .values(claimed_at=func.now())
+        .returning(NoteEmbeddingJob.id, NoteEmbeddingJob.note_id)
+        .execution_options(synchronize_session=False, query_name='note_embedding_jobs_claim')
+    )
+    jobs = result.all()
+    if not jobs:
+        await session.commit()
+        return 0
+
+    note_options = (
+        load_only(Note.owner_id, Note.name, Note.content, Note.embedding_source_hash),
+        lazyload(Note.tags),
+    )
+    result = await session.scalars(
+        select(Note)
+        .where(Note.id.in_({x.note_id for x in jobs}))
+        .options(*note_options)
+        .execution_options(query_name='note_embedding_job_notes')
+    )
+    notes = result.all()
+
+    # The text may have been embedded already, the current text is all that matters.
+    notes_to_embed = []
+    sources = []
+    for note in notes:
+        source = get_embedding_source(note.name, note.content)
+        if get_text_hash(source) != note.embedding_source_hash:
+            notes_to_embed.append(note)
+            sources.append(source)
+
+    note_id_to_chunks = await get_note_chunks(session, [x.id for x in notes_to_embed])
+    await session.commit()
+
+    note_id_to_embedded_chunks = {}
+    if notes_to_embed:
+        all_embedded_chunks = await embed_chunks(
+            session,
+            encoder,
+            [(x.owner_id, y, note_id_to_chunks[x.id]) for x, y in zip(notes_to_embed, sources)],
+        )
+        note_id_to_embedded_chunks = {
+            x.id: (get_text_hash(y), z)
+            for x, y, z in zip(notes_to_embed, sources, all_embedded_chunks)
+        }
+
+    # Locks are taken for a few statements only. A note being edited is skipped, its edit
+    # may change the text.
+    await session.connection(execution_options={'isolation_level': 'READ COMMITTED'})
+    result = await session.scalars(
+        select(Note)
+        .where(Note.id.in_({x.note_id for x in jobs}))
+        .options(*note_options)
+        .with_for_update(skip_locked=True)
+        .execution_options(populate_existing=True, query_name='note_embedding_job_notes_lock')
+    )
+    notes = result.all()
+    note_id_to_chunks = await get_note_chunks(session, list(note_id_to_embedded_chunks))
+
+    done_note_ids = set()
+    for note in notes:
+        source_hash = get_text_hash(get_embedding_source(note.name, note.content))
+        if source_hash == note.embedding_source_hash:
+            done_note_ids.add(note.id)
+            continue
+
+        embedded_source = note_id_to_embedded_chunks.get(note.id)
+        if embedded_source is None or embedded_source[0] != source_hash:
+            # Changed since the text was read.
+            continue
+
+        embedded_chunks = embedded_source[1]
+        await save_chunks(session, note, note_id_to_chunks[note.id], embedded_chunks)
+        await session.execute(
+            update_statement(Note)
+            .where(Note.id == note.id)
+            .values(
+                embedding=get_note_embedding([x[1] for x in embedded_chunks]),
+                embedding_source_hash=source_hash,
+                # It's not an edit of the note.
+                updated_at=Note.updated_at,
+                change_xid=Note.change_xid,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        done_note_ids.add(note.id)
+
+    done_job_ids = [x.id for x in jobs if x.note_id in done_note_ids]
+    if done_job_ids:
+        await session.execute(delete(NoteEmbeddingJob).where(NoteEmbeddingJob.id.in_(done_job_ids)))
+
+    # Released jobs are taken by the next batch.
+    released_job_ids = [x.id for x in jobs if x.note_id not in done_note_ids]
+    if released_job_ids:
+        await session.execute(
+            update_statement(NoteEmbeddingJob)
+            .where(NoteEmbeddingJob.id.in_(released_job_ids))
+            .values(claimed_at=None)
+            .execution_options(
+                synchronize_session=False,
+                query_name='note_embedding_jobs_release',
+            )
+        )
+
+    await session.commit()
+    return len(done_job_ids)
+
+
+async def get_note_chunks(
+    session: AsyncSession,
+    note_ids: list[uuid.UUID],
+) -> defaultdict[uuid.UUID, list[NoteChunk]]:
+    """Current chunks of the notes by the note ID."""
+    note_id_to_chunks = defaultdict(list)
+    if not note_ids:
+        return note_id_to_chunks
+
+    result = await session.scalars(
+        select(NoteChunk)
+        .where(NoteChunk.note_id.in_(note_ids))
+        .execution_options(populate_existing=True, query_name='note_chunks')
+    )
+    for chunk in result:
+        note_id_to_chunks[chunk.note_id].append(chunk)
+    return note_id_to_chunks
 
 
 async def search_notes(
     session: AsyncSession,
     owner_id: uuid.UUID,
-    st: SentenceTransformer,
-    query: str | None,
-    offset: int,
-    limit: int,
-):
-    note_query = (
-        select(Note.id, Note.name, Note.content)
-        .where(Note.owner_id == owner_id)
-        .offset(offset)
-        .limit(limit)
-    )
+    encoder: Encoder,
+    params: NotesRead,
+) -> tuple[list[dict], str | None]:
+    """Return a page of notes and a cursor of the next page if there is one."""
+    cursor = parse_note_cursor(params.cursor) if params.cursor else None
 
-    if query:
-        query_embedding = st.encode([query])[0]
-        score = 1 - Note.embedding.cosine_distance(query_embedding)
+    hit_count = None
+    if params.q and params.mode == SearchMode.KEYWORD:
+        # No need to run the model.
+        note_query = get_keyword_search_query(owner_id, params, cursor)
+        note_query = note_query.execution_options(query_name='note_keyword_search')
+    elif params.q:
+        query_embedding = await encoder.encode_query(params.q)
+        await configure_vector_search(session)
+        if params.mode == SearchMode.HYBRID:
+            candidate_count = max(
+                params.offset + params.limit + 1,
+                NOTE_SEARCH_HYBRID_CANDIDATE_COUNT,
+            )
+            note_query = get_hybrid_search_query(owner_id, params, query_embedding, candidate_count)
+            note_query = note_query.execution_options(query_name='note_hybrid_search')
+        else:
+            # Notes may have several matching chunks, so look at more chunks than notes needed.
+            hit_count = (params.offset + params.limit + 1) * NOTE_SEARCH_CHUNK_OVERFETCH
+            note_query = get_semantic_search_query(
+                owner_id,
+                params,
+                query_embedding,
+                cursor,
+                hit_count,
+            )
+            note_query = note_query.execution_options(query_name='note_semantic_search')
+    else:
         note_query = (
-            note_query.where(Note.embedding.is_not(None)).where(score > 0.1).order_by(score.desc())
+            select(Note.id, Note.created_at)
+            .where(Note.owner_id == owner_id)
+            .where(*get_tag_conditions(owner_id, Note.id, params))
+            .order_by(Note.created_at.desc(), Note.id.desc())
+            .execution_options(query_name='note_list')
         )
+        if cursor:
+            # The first condition is redundant but lets the owner/created_at index seek.
+            note_query = note_query.where(Note.created_at <= cursor['created_at']).where(
+                or_(
+                    Note.created_at < cursor['created_at'],
+                    and_(Note.created_at == cursor['created_at'], Note.id < cursor['id']),
+                )
+            )
 
-    note_query = note_query.order_by(Note.created_at.desc())
+    # Search queries select the ids and the ranks, the returned fields are added here.
+    columns = get_note_columns(params)
+    note_query = note_query.add_columns(*columns)
+
+    # One extra row tells whether there is a next page.
+    note_query = note_query.offset(params.offset).limit(params.limit + 1)
 
     result = await session.execute(note_query)
     raw_notes = result.fetchall()
 
-    note_id_to_tag = defaultdict(list)
+    has_next_page = len(raw_notes) > params.limit
+    if hit_count and raw_notes and raw_notes[0].hit_count >= hit_count:
+        # All chunk candidates were used up before the page was full, there may be more notes.
+        has_next_page = True
+
+    next_cursor = None
+    raw_notes = raw_notes[: params.limit]
+    if has_next_page and raw_notes:
+        last = raw_notes[-1]
+        if not params.q:
+            created_at = last.created_at.isoformat()
+            next_cursor = encode_cursor({'created_at': created_at, 'id': str(last.id)})
+        elif params.mode == SearchMode.SEMANTIC:
+            next_cursor = encode_cursor({'distance': last.distance, 'id': str(last.id)})
+        elif params.mode == SearchMode.KEYWORD:
+            next_cursor = encode_cursor({'rank': last.rank, 'id': str(last.id)})
+
+    note_id_to_tags = {}
+    with_tags = NoteField.TAGS in params.fields
+    if with_tags and raw_notes:
+        note_id_to_tags = await get_note_tags(session, owner_id, [x.id for x in raw_notes])
+
+    notes = []
+    for x in raw_notes:
+        note = {'id': x.id, **{column.key: x._mapping[column.key] for column in columns}}
+        if with_tags:
+            note['tags'] = note_id_to_tags.get(x.id, [])
+        notes.append(note)
+    return notes, next_cursor
+
+
+async def get_note_tags(
+    session: AsyncSession,
+    owner_id: uuid.UUID,
+    note_ids: list[uuid.UUID],
+) -> dict[uuid.UUID, list[dict]]:
+    """Tags of the notes by one query, notes without tags are left out."""
+    tag_query = (
+        select(Tag.id, Tag.name, note_tag_m2m.c.note_id)
+        .join(note_tag_m2m, note_tag_m2m.c.tag_id == Tag.id)
+        .where(Tag.owner_id == owner_id)
+        .where(note_tag_m2m.c.note_id.in_(note_ids))
+        .execution_options(query_name='note_search_tags')
+    )
+    result = await session.execute(tag_query)
+
+    note_id_to_tags = defaultdict(list)
+    for tag_id, tag_name, note_id in result:
+        note_id_to_tags[note_id].append({'id': tag_id, 'name': tag_name})
+    return note_id_to_tags
+
+
+async def get_similar_notes(
+    session: AsyncSession,
+    owner_id: uuid.UUID,
+    note_ids: list[uuid.UUID],
+    params: SimilarNotesRead,
+) -> dict[uuid.UUID, list[dict]]:
+    """
+    Notes closest to each of the given ones. The stored note embeddings are the query vectors,
+    so the model isn't run. Notes still waiting for an embedding have no similar notes.
+    """
+    await configure_vector_search(session)
+
+    source = aliased(Note, name='source')
+    candidate = aliased(Note, name='candidate')
+    distance = candidate.embedding.cosine_distance(source.embedding)
+    # One HNSW index scan for each source note.
+    similar = (
+        select(candidate.id, distance.label('distance'))
+        .where(candidate.owner_id == owner_id)
+        .where(candidate.id != source.id)
+        .where(distance < 1 - NOTE_SEARCH_MIN_SCORE)
+        .where(*get_tag_conditions(owner_id, candidate.id, params))
+        .order_by(distance)
+        .limit(params.limit)
+        .lateral('similar')
+    )
+    note_query = (
+        select(source.id.label('source_id'), Note.id, Note.name, Note.content)
+        .select_from(source)
+        .join(similar, true())
+        .join(Note, Note.id == similar.c.id)
+        .where(source.id.in_(note_ids))
+        .where(source.owner_id == owner_id)
+        .order_by(source.id, similar.c.distance, Note.id)
+        .execution_options(query_name='note_similar')
+    )
+    result = await session.execute(note_query)
+    raw_notes = result.fetchall()
+
+    note_id_to_tags = {}
     if raw_notes:
-        note_ids = [x[0] for x in raw_notes]
-        tag_query = (
-            select(Tag.id, Tag.name, Note.id)
-            .outerjoin(note_tag_m2m, note_tag_m2m.c.tag_id == Tag.id)
-            .join(Note, Note.id == note_tag_m2m.c.note_id)
-            .where(Tag.owner_id == owner_id)
+        note_id_to_tags = await get_note_tags(session, owner_id, list({x.id for x in raw_notes}))
+
+    note_id_to_similar = {x: [] for x in note_ids}
+    for x in raw_notes:
+        note_id_to_similar[x.source_id].append(
+            {
+                'id': x.id,
+                'name': x.name,
+                'content': x.content,
+                'tags': note_id_to_tags.get(x.id, []),
+            }
+        )
+    return note_id_to_similar
+
+
+async def export_notes(
+    session: AsyncSession,
+    owner_id: uuid.UUID,
+    params: NotesExportRead,
+) -> AsyncGenerator[bytes]:
+    """
+    All notes of the owner as NDJSON, the oldest first. Rows are read from a server-side cursor
+    by batches, so memory use doesn't depend on the number of notes.
+    """
+    columns = [Note.id, Note.name, Note.content, Note.created_at, Note.updated_at]
+    if params.embeddings:
+        columns.append(Note.embedding)
+    note_query = (
+        select(*columns)
+        .where(Note.owner_id == owner_id)
+        .order_by(Note.created_at, Note.id)
+        .execution_options(yield_per=NOTE_EXPORT_BATCH_SIZE, query_name='note_export')
+    )
+    result = await session.stream(note_query)
+
+    async for raw_notes in result.partitions():
+        note_id_to_tags = {}
+        if params.tags:
+            note_id_to_tags = await get_note_tags(session, owner_id, [x.id for x in raw_notes])
+
+        lines = []
+        for x in raw_notes:
+            note = {
+                'id': x.id,
+                'name': x.name,
+                'content': x.content,
+                'created_at': x.created_at,
+                'updated_at': x.updated_at,
+            }
+            if params.tags:
+                note['tags'] = note_id_to_tags.get(x.id, [])
+            if params.embeddings:
+                note['embedding'] = None if x.embedding is None else x.embedding.tolist()
+            lines.append(NoteExportPublic(**note).model_dump_json(exclude_unset=True).encode())
+        yield b'\n'.join(lines) + b'\n'
+
+
+async def get_changes(
+    session: AsyncSession,
+    owner_id: uuid.UUID,
+    params: NoteChangesRead,
+) -> dict:
+    """
+    Notes and tags changed or deleted since the token, in the order of the changes.
+
+    Changes are paged by a `(change_xid, id)` keyset over the three tables. Changes of
+    transactions that may still be running are left for the next sync, so a transaction
+    committing late can't slip behind a token.
+    """
+    since = parse_changes_token(params.since) if params.since else None
+    # All statements read one snapshot, otherwise a note or tag deleted between them would
+    # be missing. A read-only transaction never fails on a serialization failure.
+    await session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+
+    # Every transaction below it has committed or rolled back.
+    horizon = literal_column('pg_snapshot_xmin(pg_current_snapshot())::text::bigint')
+    result = await session.execute(
+        select(horizon).execution_options(query_name='note_changes_horizon')
+    )
+    until = result.scalar_one()
+
+    def get_change_query(entity, is_deleted, id_column, change_xid_column, owner_id_column):
+        query = (
+            select(
+                entity.label('entity'),
+                literal(is_deleted).label('is_deleted'),
+                id_column.label('id'),
+                change_xid_column.label('change_xid'),
+            )
+            .where(owner_id_column == owner_id)
+            .where(change_xid_column < until)
+            .order_by(change_xid_column, id_column)
+            .limit(params.limit + 1)
+        )
+        if since:
+            # The first condition is redundant but lets the owner/change_xid index seek.
+            query = query.where(change_xid_column >= since['change_xid']).where(
+                tuple_(change_xid_column, id_column) > tuple_(since['change_xid'], since['id'])
+            )
+        return query
+
+    changes = union_all(
+        get_change_query(
+            literal(DeletedEntity.NOTE.value),
+            False,
+            Note.id,
+            Note.change_xid,
+            Note.owner_id,
+        ),
+        get_change_query(
+            literal(DeletedEntity.TAG.value),
+            False,
+            Tag.id,
+            Tag.change_xid,
+            Tag.owner_id,
+        ),
+        get_change_query(
+            DeletionLog.entity,
+            True,
+            DeletionLog.entity_id,
+            DeletionLog.change_xid,
+            DeletionLog.owner_id,
+        ),
+    ).subquery('changes')
+    change_query = (
+        select(changes)
+        .order_by(changes.c.change_xid, changes.c.id)
+        .limit(params.limit + 1)
+        .execution_options(query_name='note_changes')
+    )
+    result = await session.execute(change_query)
+    raw_changes = result.all()
+
+    has_more = len(raw_changes) > params.limit
+    raw_changes = raw_changes[: params.limit]
+    if has_more:
+        last = raw_changes[-1]
+        next_token = encode_cursor({'change_xid': last.change_xid, 'id': str(last.id)})
+    elif since and since['change_xid'] >= until:
+        next_token = params.since
+    else:
+        # Everything before `until` has been seen.
+        next_token = encode_cursor({'change_xid': until, 'id': str(uuid.UUID(int=0))})
+
+    note_ids = [x.id for x in raw_changes if x.entity == DeletedEntity.NOTE and not x.is_deleted]
+    notes = []
+    if note_ids:
+        result = await session.scalars(
+            select(Note)
             .where(Note.id.in_(note_ids))
+            .execution_options(query_name='note_changes_notes')
         )
-        result = await session.execute(tag_query)
+        id_to_note = {x.id: x for x in result.unique()}
+        notes = [id_to_note[x] for x in note_ids]
 
-        for tag_id, tag_name, note_id in result:
-            note_id_to_tag[note_id].append({'id': tag_id, 'name': tag_name})
+    tag_ids = [x.id for x in raw_changes if x.entity == DeletedEntity.TAG and not x.is_deleted]
+    tags = []
+    if tag_ids:
+        result = await session.scalars(
+            select(Tag).where(Tag.id.in_(tag_ids)).execution_options(query_name='tags_by_id')
+        )
+        id_to_tag = {x.id: x for x in result}
+        tags = [id_to_tag[x] for x in tag_ids]
 
-    return [
-        {'id': id_, 'name': name, 'content': content, 'tags': note_id_to_tag[id_]}
-        for id_, name, content in raw_notes
-    ]
+    return {
+        'notes': notes,
+        'tags': tags,
+        'deleted': [{'entity': x.entity, 'id': x.id} for x in raw_changes if x.is_deleted],
+        'next_token': next_token,
+        'has_more': has_more,
+    }
+
+
+def get_note_columns(params: NotesRead) -> list:
+    """Columns of the requested note fields. Snippets are cut in SQL to not fetch the content."""
+    columns = []
+    if NoteField.NAME in params.fields:
+        columns.append(Note.name)
+    if NoteField.CONTENT in params.fields:
+        columns.append(Note.content)
+
+    if params.snippet_length:
+        content = Note.content
+        if params.q and params.mode != SearchMode.SEMANTIC:
+            # A fragment around the matched words, roughly as long as the snippet.
+            max_words = max(params.snippet_length // NOTE_SNIPPET_CHARS_PER_WORD, 2)
+            options = f'StartSel="",StopSel="",MaxWords={max_words},MinWords={max_words // 2}'
+            content = func.ts_headline(
+                'simple',
+                Note.content,
+                func.websearch_to_tsquery('simple', params.q),
+                options,
+            )
+        columns.append(func.left(content, params.snippet_length).label('snippet'))
+
+    return columns
+
+
+def get_tag_conditions(owner_id: uuid.UUID, note_id, params: NoteTagFilter) -> list:
+    """
+    Conditions on `note_id` for the tag filters. They are put into the search queries
+    instead of filtering pages afterwards, so filtered pages are still full.
+    """
+
+    def has_tags(names: list[str]):
+        return (
+            select(note_tag_m2m.c.note_id)
+            .join(Tag, Tag.id == note_tag_m2m.c.tag_id)
+            .where(note_tag_m2m.c.note_id == note_id)
+            .where(Tag.owner_id == owner_id)
+            .where(Tag.name.in_(names))
+            .exists()
+        )
+
+    conditions = [has_tags([x]) for x in dict.fromkeys(params.tags)]
+    if params.any_tags:
+        conditions.append(has_tags(params.any_tags))
+    if params.exclude_tags:
+        conditions.append(~has_tags(params.exclude_tags))
+    return conditions
+
+
+def get_semantic_search_query(
+    owner_id: uuid.UUID,
+    params: NotesRead,
+    query_embedding: list[float],
+    cursor: dict | None,
+    hit_count: int,
+):
+    """
+    Notes are ranked by their closest chunk. The closest `hit_count` chunks are taken
+    from the HNSW index first and then grouped by notes. Tag filters are checked during
+    the index scan, iterative scans keep it going until enough chunks pass them.
+    """
+    distance = NoteChunk.embedding.cosine_distance(query_embedding)
+
+    # Order by the bare distance, otherwise the HNSW index can't be used.
+    hit_query = (
+        select(NoteChunk.note_id, distance.label('distance'))
+        .where(NoteChunk.owner_id == owner_id)
+        .where(distance < 1 - NOTE_SEARCH_MIN_SCORE)
+        .where(*get_tag_conditions(owner_id, NoteChunk.note_id, params))
+        .order_by(distance)
+        .limit(hit_count)
+    )
+    if cursor:
+        hit_query = hit_query.where(distance >= cursor['distance'])
+    hits = hit_query.cte('hits')
+
+    note_distance = func.min(hits.c.distance).label('distance')
+    best_hit_query = select(hits.c.note_id, note_distance).group_by(hits.c.note_id)
+    if cursor:
+        # Notes with a chunk closer than the cursor were on previous pages.
+        closer_chunk = (
+            select(NoteChunk.note_id)
+            .where(NoteChunk.note_id == hits.c.note_id)
+            .where(distance < cursor['distance'])
+        )
+        best_hit_query = best_hit_query.where(~closer_chunk.exists()).having(
+            or_(
+                note_distance > cursor['distance'],
+                and_(note_distance == cursor['distance'], hits.c.note_id > cursor['id']),
+            )
+        )
+    best_hits = best_hit_query.subquery('best_hits')
+
+    note_query = (
+        select(
+            Note.id,
+            best_hits.c.distance,
+            select(func.count()).select_from(hits).scalar_subquery().label('hit_count'),
+        )
+        .join(best_hits, best_hits.c.note_id == Note.id)
+        .order_by(best_hits.c.distance, Note.id)
+    )
+    return note_query
+
+
+def get_keyword_search_query(owner_id: uuid.UUID, params: NotesRead, cursor: dict | None):
+    """Notes matching the full text search query, the most relevant first."""
+    ts_query = func.websearch_to_tsquery('simple', params.q)
+    rank = func.ts_rank_cd(Note.search_vector, ts_query)
+
+    note_query = (
+        select(Note.id, rank.label('rank'))
+        .where(Note.owner_id == owner_id)
+        .where(Note.search_vector.bool_op('@@')(ts_query))
+        .where(*get_tag_conditions(owner_id, Note.id, params))
+        .order_by(rank.desc(), Note.id)
+    )
+    if cursor:
+        note_query = note_query.where(
+            or_(
+                rank < cursor['rank'],
+                and_(rank == cursor['rank'], Note.id > cursor['id']),
+            )
+        )
+    return note_query
+
+
+def get_hybrid_search_query(
+    owner_id: uuid.UUID,
+    params: NotesRead,
+    query_embedding: list[float],
+    candidate_count: int,
+):
+    """
+    Reciprocal rank fusion of the semantic and the keyword search: a note gets
+    `1 / (k + rank)` for every result list it is in. Both lists are cut at `candidate_count`.
+    """
+    hit_count = candidate_count * NOTE_SEARCH_CHUNK_OVERFETCH
+    semantic_hits = (
+        get_semantic_search_query(owner_id, params, query_embedding, None, hit_count)
+        .limit(candidate_count)
+        .subquery('semantic_hits')
+    )
+    semantic = select(
+        semantic_hits.c.id,
+        func.row_number()
+        .over(order_by=(semantic_hits.c.distance, semantic_hits.c.id))
+        .label('rank'),
+    ).subquery('semantic')
+
+    keyword_hits = (
+        get_keyword_search_query(owner_id, params, None)
+        .limit(candidate_count)
+        .subquery('keyword_hits')
+    )
+    keyword = select(
+        keyword_hits.c.id,
+        func.row_number()
+        .over(order_by=(keyword_hits.c.rank.desc(), keyword_hits.c.id))
+        .label('rank'),
+    ).subquery('keyword')
+
+    score = func.coalesce(1.0 / (NOTE_SEARCH_RRF_K + semantic.c.rank), 0) + func.coalesce(
+        1.0 / (NOTE_SEARCH_RRF_K + keyword.c.rank), 0
+    )
+    fused = (
+        select(func.coalesce(semantic.c.id, keyword.c.id).label('id'), score.label('score'))
+        .select_from(semantic.join(keyword, keyword.c.id == semantic.c.id, full=True))
+        .subquery('fused')
+    )
+
+    note_query = (
+        select(Note.id, fused.c.score)
+        .join(fused, fused.c.id == Note.id)
+        .order_by(fused.c.score.desc(), Note.id)
+    )
+    return note_query
+
+
+async def configure_vector_search(session: AsyncSession):
+    """Set HNSW search parameters for the rest of the current transaction."""
+    await session.execute(
+        select(
+            func.set_config('hnsw.ef_search', str(settings.DB_HNSW_EF_SEARCH), True),
+            func.set_config('hnsw.iterative_scan', settings.DB_HNSW_ITERATIVE_SCAN, True),
+            func.set_config('hnsw.max_scan_tuples', str(settings.DB_HNSW_MAX_SCAN_TUPLES), True),
+        ).execution_options(query_name='vector_search_config')
+    )
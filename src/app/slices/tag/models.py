@@ -1,13 +1,14 @@
 import uuid
 
 from pydantic import Field
-from sqlalchemy import UniqueConstraint, types
+from sqlalchemy import Index, UniqueConstraint, types
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.core.models import (
     AuditMixin,
     BaseSchema,
     BaseSQLModel,
+    ChangeMixin,
     OwnerMixin,
     PrimaryUUIDMixin,
 )
@@ -15,8 +16,11 @@ from app.core.models import (
 from .constants import TAG_NAME_MAX_LENGTH, TAG_NAME_MIN_LENGTH
 
 
-class Tag(PrimaryUUIDMixin, AuditMixin, OwnerMixin, BaseSQLModel):
-    __table_args__ = (UniqueConstraint('name', 'owner_id', name='unique_name_owner'),)
+class Tag(PrimaryUUIDMixin, AuditMixin, ChangeMixin, OwnerMixin, BaseSQLModel):
+    __table_args__ = (
+        UniqueConstraint('name', 'owner_id', name='unique_name_owner'),
+        Index('tag_owner_id_change_xid_idx', 'owner_id', 'change_xid'),
+    )
 
     name: Mapped[str] = mapped_column(types.String(TAG_NAME_MAX_LENGTH), nullable=False)
 
@@ -1,10 +1,15 @@
+import datetime as dt
 import uuid
 
 from fastapi import APIRouter, HTTPException
+from sqlalchemy import delete, select, update
 
-from app.core.db import SessionDep
+from app.core.db import ReadOnlySessionDep, SessionDep, run_transaction
+from app.core.events import EventAction, notify
+from app.core.models import DeletedEntity, DeletionLog
 from app.core.response import generate_openapi_error_responses
 from app.core.security import CurrentUserIDDep
+from app.slices.note.models import Note, note_tag_m2m
 
 from .models import Tag, TagCreate, TagPublic, TagUpdate
 
@@ -16,16 +21,20 @@ router = APIRouter()
     response_model=TagPublic,
     responses=generate_openapi_error_responses({403, 404}),
 )
-async def read_tag(id: uuid.UUID, session: SessionDep, current_user_id: CurrentUserIDDep):
+async def read_tag(id: uuid.UUID, session: ReadOnlySessionDep, current_user_id: CurrentUserIDDep):
     tag = await get_or_40x(session, current_user_id, id)
     return TagPublic.model_validate(tag)
 
 
 @router.post('/', response_model=TagPublic)
 async def create_tag(*, session: SessionDep, current_user_id: CurrentUserIDDep, tag_in: TagCreate):
-    tag = Tag(name=tag_in.name, owner_id=current_user_id)
-    session.add(tag)
-    await session.commit()
+    async def work():
+        tag = Tag(name=tag_in.name, owner_id=current_user_id)
+        session.add(tag)
+        await notify(session, current_user_id, 'tag', EventAction.CREATED, [tag.id])
+        return tag
+
+    tag = await run_transaction(session, work)
     return TagPublic.model_validate(tag)
 
 
@@ -41,16 +50,19 @@ async def update_tag(
     id: uuid.UUID,
     tag_in: TagUpdate,
 ):
-    tag = await get_or_40x(session, current_user_id, id)
-
     update_data = tag_in.model_dump(exclude_unset=True)
-    if not update_data:
-        return
 
-    for column, value in update_data.items():
-        setattr(tag, column, value)
+    async def work():
+        tag = await get_or_40x(session, current_user_id, id)
+        if not update_data:
+            return
+
+        for column, value in update_data.items():
+            setattr(tag, column, value)
+
+        await notify(session, current_user_id, 'tag', EventAction.UPDATED, [tag.id])
 
-    await session.commit()
+    await run_transaction(session, work)
 
 
 @router.delete(
@@ -59,13 +71,39 @@ async def update_tag(
     responses=generate_openapi_error_responses({403, 404}),
 )
 async def delete_tag(*, session: SessionDep, current_user_id: CurrentUserIDDep, id: uuid.UUID):
-    tag = await get_or_40x(session, current_user_id, id)
-    await session.delete(tag)
-    await session.commit()
+    async def work():
+        # Links to notes are deleted by the database cascade. The notes lose the tag, so they
+        # change for clients syncing changes.
+        result = await session.execute(
+            update(Note)
+            .where(Note.id.in_(select(note_tag_m2m.c.note_id).where(note_tag_m2m.c.tag_id == id)))
+            .where(Note.owner_id == current_user_id)
+            .values(updated_at=dt.datetime.now(dt.timezone.utc))
+            .returning(Note.id)
+            .execution_options(synchronize_session=False, query_name='tag_delete_note_update')
+        )
+        note_ids = result.scalars().all()
+
+        result = await session.execute(
+            delete(Tag)
+            .where(Tag.id == id)
+            .where(Tag.owner_id == current_user_id)
+            .returning(Tag.id)
+            .execution_options(query_name='tag_delete')
+        )
+        if result.scalar_one_or_none() is None:
+            # Not deleted, find out why.
+            await get_or_40x(session, current_user_id, id)
+
+        session.add(DeletionLog(entity=DeletedEntity.TAG, entity_id=id, owner_id=current_user_id))
+        await notify(session, current_user_id, 'tag', EventAction.DELETED, [id])
+        await notify(session, current_user_id, 'note', EventAction.UPDATED, note_ids)
+
+    await run_transaction(session, work)
 
 
 async def get_or_40x(session: SessionDep, current_user_id: CurrentUserIDDep, id: uuid.UUID):
-    tag = await session.get(Tag, id)
+    tag = await session.get(Tag, id, execution_options={'query_name': 'tag_get'})
     if not tag:
         raise HTTPException(status_code=404, detail=f'Tag {id} was not found.')
 
@@ -1,28 +1,83 @@
+import datetime as dt
 import uuid
 
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
 
+from app.core.events import EventAction, notify
 from app.slices.tag.models import Tag
 
+TAG_COLUMNS = (Tag.id, Tag.name, Tag.owner_id, Tag.created_at, Tag.updated_at)
+
 
 async def get_or_create_tags(
     session: AsyncSession,
     owner_id: uuid.UUID,
     tag_names: list[str],
 ) -> list[Tag]:
-    tags = []
+    """
+    Tags of the names in the order of the names, created if missing.
+
+    Tags are resolved in a short READ COMMITTED transaction of their own, at most three
+    statements: the INSERT skips names taken by concurrent transactions and the SELECT sees
+    them, which a REPEATABLE READ snapshot would not. Call it before the first statement of
+    the session's transaction, so that its snapshot has the new tags.
+
+    New tags are committed, and their `created` events sent, whether the session's
+    transaction commits or not. They stay as tags without notes, like ones made by
+    `POST /tags`.
+    """
+    tag_names = list(dict.fromkeys(tag_names))
     if not tag_names:
-        return tags
+        return []
 
-    query = select(Tag).where(Tag.name.in_(tag_names)).where(Tag.owner_id == owner_id)
-    result = await session.execute(query)
-    tags.extend(result.scalars().all())
+    # Column defaults of the dataclass are not applied to Core rows. Sorted, so that concurrent
+    # transactions wait on the names in the same order and do not deadlock.
+    now = dt.datetime.now(dt.timezone.utc)
+    rows = [
+        {'id': uuid.uuid4(), 'name': x, 'owner_id': owner_id, 'created_at': now, 'updated_at': now}
+        for x in sorted(tag_names)
+    ]
+    async with session.bind.connect() as connection:
+        await connection.execution_options(isolation_level='READ COMMITTED')
+        async with connection.begin():
+            result = await connection.execute(
+                insert(Tag)
+                .on_conflict_do_nothing(constraint='unique_name_owner')
+                .returning(*TAG_COLUMNS)
+                .execution_options(query_name='tags_insert'),
+                rows,
+            )
+            name_to_row = {x.name: x for x in result}
+            await notify(
+                connection,
+                owner_id,
+                'tag',
+                EventAction.CREATED,
+                [x.id for x in name_to_row.values()],
+            )
+
+            existing_tag_names = [x for x in tag_names if x not in name_to_row]
+            if existing_tag_names:
+                result = await connection.execute(
+                    select(*TAG_COLUMNS)
+                    .where(Tag.name.in_(existing_tag_names))
+                    .where(Tag.owner_id == owner_id)
+                    .execution_options(query_name='tags_by_name')
+                )
+                name_to_row.update((x.name, x) for x in result)
+
+    tags = []
+    for name in tag_names:
+        # A tag deleted by a concurrent transaction is left out.
+        if name not in name_to_row:
+            continue
 
-    if len(tag_names) > len(tags):
-        new_tag_names = set(tag_names) - set(x.name for x in tags)
-        new_tags = [Tag(name=x, owner_id=owner_id) for x in new_tag_names]
-        session.add_all(new_tags)
-        tags.extend(new_tags)
+        # The committed rows become tags of the session without loading them again.
+        tag = Tag(**name_to_row[name]._mapping)
+        make_transient_to_detached(tag)
+        tags.append(await session.merge(tag, load=False))
 
     return tags
@@ -1,19 +1,26 @@
 import uuid
 
+import pytest
 import pytest_asyncio
 from asgi_lifespan import LifespanManager
 from httpx import ASGITransport, AsyncClient
-from sentence_transformers import SentenceTransformer
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 
 from app.core.config import settings
-from app.core.db import get_session
+from app.core.db import (
+    READ_ONLY_EXECUTION_OPTIONS,
+    get_read_only_session,
+    get_session,
+    get_session_factory,
+)
 from app.core.models import BaseSQLModel
 from app.core.security import get_current_user_id
 from app.main import app
+from app.slices.note import encoder as encoder_module
+from app.slices.note.encoder import Encoder
 from app.slices.note.service import create as note_service_create
 from app.slices.tag.models import Tag
 
@@ -79,17 +86,45 @@ async def lifespan_manager_fixture():
         yield manager
 
 
-@pytest_asyncio.fixture(name='st', scope='session')
-async def sentence_transformer_fixture(lm) -> SentenceTransformer:
-    return lm._state['st']
+@pytest_asyncio.fixture(name='encoder', scope='session')
+async def encoder_fixture(lm) -> Encoder:
+    return lm._state['encoder']
+
+
+@pytest_asyncio.fixture(name='encoded_texts')
+def encoded_texts_fixture(encoder: Encoder, monkeypatch: pytest.MonkeyPatch):
+    """Texts passed to the model while the test runs."""
+    texts = []
+    encode = encoder_module.encode
+
+    def encode_spy(batch: list[str]):
+        texts.extend(batch)
+        return encode(batch)
+
+    monkeypatch.setattr(encoder_module, 'encode', encode_spy)
+    yield texts
 
 
 @pytest_asyncio.fixture(name='client')
-async def client_fixture(lm: LifespanManager, session: AsyncSession):
+async def client_fixture(lm: LifespanManager, session: AsyncSession, db_engine):
     def get_session_override():
         return session
 
+    async def get_read_only_session_override():
+        sm = sessionmaker(
+            db_engine.execution_options(**READ_ONLY_EXECUTION_OPTIONS),
+            class_=AsyncSession,
+            expire_on_commit=False,
+        )
+        async with sm() as read_only_session:
+            yield read_only_session
+
+    def get_session_factory_override():
+        return sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+
     app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_read_only_session] = get_read_only_session_override
+    app.dependency_overrides[get_session_factory] = get_session_factory_override
 
     try:
         async with AsyncClient(
@@ -117,13 +152,13 @@ async def current_user_id_fixture():
 
 
 @pytest_asyncio.fixture()
-def create_note(session: AsyncSession, current_user_id: uuid.UUID, st):
+def create_note(session: AsyncSession, current_user_id: uuid.UUID, encoder: Encoder):
     async def create(**values):
         values.setdefault('name', 'test')
         values.setdefault('content', '')
         values.setdefault('owner_id', current_user_id)
 
-        note = note_service_create(session, st, **values)
+        note = await note_service_create(session, encoder, **values)
         await session.commit()
         return note
 
@@ -0,0 +1,198 @@
+import asyncio
+import functools
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from app.core.config import EncoderBackend
+from app.slices.note import encoder as encoder_module
+from app.slices.note.encoder import EmbeddingCache, Encoder, HostExecutor, create_model
+from app.slices.note.encoder_host import handle_connection
+
+PARITY_TEXTS = [
+    'How to configure FastAPI with PostgreSQL and asyncpg',
+    'Introduction to neural networks and machine learning concepts',
+    'groceries: milk, eggs, bread',
+]
+
+
+@functools.cache
+def get_torch_embeddings() -> np.ndarray:
+    # Loaded once for all backends, and only when one of them is installed.
+    return create_model(EncoderBackend.TORCH).encode(PARITY_TEXTS)
+
+
+@pytest.mark.asyncio
+async def test_encode_does_not_block_event_loop(encoder: Encoder):
+    """Other coroutines should keep running while the model encodes."""
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    task = asyncio.create_task(tick())
+    try:
+        await encoder.encode(['a long enough text to take a while ' * 20] * 32)
+    finally:
+        task.cancel()
+
+    assert ticks > 1
+
+
+@pytest.mark.asyncio
+async def test_encode_rejects_jobs_over_queue_limit(encoder: Encoder):
+    """Should answer 503 instead of queueing more jobs than allowed."""
+    bounded_encoder = Encoder(ThreadPoolExecutor(max_workers=1), workers=1, queue_max_size=1)
+    try:
+        results = await asyncio.gather(
+            bounded_encoder.encode(['first']),
+            bounded_encoder.encode(['second']),
+            return_exceptions=True,
+        )
+    finally:
+        bounded_encoder.close()
+
+    assert isinstance(results[0], list)
+    assert isinstance(results[1], HTTPException)
+    assert results[1].status_code == 503
+
+
+@pytest.mark.asyncio
+async def test_split_texts_in_one_job(encoder: Encoder):
+    """Should split any number of long texts by one job and keep short ones whole."""
+    bounded_encoder = Encoder(ThreadPoolExecutor(max_workers=1), workers=1, queue_max_size=1)
+    texts = ['short', *(f'long text {i} ' * 100 for i in range(3))]
+    try:
+        chunks = await bounded_encoder.split(texts, 200, 32)
+    finally:
+        bounded_encoder.close()
+
+    assert chunks[0] == ['short']
+    assert chunks[1:] == encoder_module.split(texts[1:], 200, 32)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_encodes_are_batched(encoder: Encoder, monkeypatch: pytest.MonkeyPatch):
+    """Should embed texts of concurrent calls with one model call and split the result back."""
+    texts = ['notes', 'tags', 'semantic search']
+    expected = [encoder_module.encode([x])[0] for x in texts]
+
+    batch_sizes = []
+
+    def encode_spy(texts: list[str]):
+        batch_sizes.append(len(texts))
+        return encoder_module._model.encode(texts).tolist()
+
+    monkeypatch.setattr(encoder_module, 'encode', encode_spy)
+
+    results = await asyncio.gather(*(encoder.encode([x]) for x in texts))
+
+    assert batch_sizes == [len(texts)]
+    for [embedding], expected_embedding in zip(results, expected):
+        assert np.allclose(embedding, expected_embedding, atol=1e-6)
+
+
+@pytest.mark.asyncio
+async def test_encode_query_uses_cache(encoder: Encoder, encoded_texts: list[str]):
+    """Queries differing only in case and whitespace should be encoded once."""
+    first = await encoder.encode_query('How to  deploy FastAPI?')
+    second = await encoder.encode_query(' how to deploy fastapi? ')
+
+    assert encoded_texts == ['how to deploy fastapi?']
+    assert first == second
+
+
+@pytest.mark.asyncio
+async def test_encode_on_encoder_host(encoder: Encoder, tmp_path):
+    """Should get the same embeddings from the encoder host as from the local model."""
+    path = str(tmp_path / 'encoder_host.sock')
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: handle_connection(encoder, reader, writer),
+        path=path,
+    )
+    async with server:
+        host_encoder = Encoder(HostExecutor(path, max_workers=2), workers=2, queue_max_size=8)
+        try:
+            texts = ['notes', 'tags', 'semantic search']
+            results = await asyncio.gather(*(host_encoder.encode([x]) for x in texts))
+        finally:
+            host_encoder.close()
+
+    expected = await encoder.encode(texts)
+    assert np.allclose([x for [x] in results], expected, atol=1e-6)
+
+
+def test_app_on_encoder_host_does_not_load_model_libraries():
+    """App workers sending jobs to the encoder host should not import torch."""
+    code = (
+        'import sys, app.main; '
+        "print('torch' in sys.modules, 'sentence_transformers' in sys.modules)"
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', code],
+        env={**os.environ, 'ENCODER_EXECUTOR': 'host'},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.split() == ['False', 'False']
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = EmbeddingCache(max_size=2)
+    cache.set('a', [1.0])
+    cache.set('b', [2.0])
+    assert cache.get('a') == [1.0]
+
+    cache.set('c', [3.0])
+
+    assert cache.get('b') is None
+    assert cache.get('a') == [1.0]
+    assert cache.get('c') == [3.0]
+
+
+def test_embedding_cache_expires_entries(monkeypatch: pytest.MonkeyPatch):
+    now = 1000.0
+    monkeypatch.setattr(encoder_module.time, 'monotonic', lambda: now)
+
+    cache = EmbeddingCache(max_size=2, ttl=10)
+    cache.set('a', [1.0])
+    assert cache.get('a') == [1.0]
+
+    now += 10
+    assert cache.get('a') is None
+
+
+@pytest.mark.parametrize(
+    'backend, model_file, min_similarity',
+    (
+        (EncoderBackend.ONNX, None, 0.999),
+        (EncoderBackend.ONNX, 'onnx/model_quint8_avx2.onnx', 0.95),
+        (EncoderBackend.OPENVINO, None, 0.999),
+        (EncoderBackend.OPENVINO, 'openvino/openvino_model_qint8_quantized.xml', 0.95),
+    ),
+)
+def test_backend_parity(backend: EncoderBackend, model_file: str | None, min_similarity: float):
+    """
+    Embeddings of other backends should stay close to the PyTorch ones. Install the `onnx`
+    and `openvino` extras to run it.
+    """
+    pytest.importorskip(
+        'optimum.onnxruntime' if backend == EncoderBackend.ONNX else 'optimum.intel'
+    )
+
+    torch_embeddings = get_torch_embeddings()
+    embeddings = create_model(backend, model_file).encode(PARITY_TEXTS)
+
+    similarities = np.sum(torch_embeddings * embeddings, axis=1) / (
+        np.linalg.norm(torch_embeddings, axis=1) * np.linalg.norm(embeddings, axis=1)
+    )
+    assert similarities.min() >= min_similarity
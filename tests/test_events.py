@@ -0,0 +1,95 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.events import EventAction, EventBroker, notify, stream_events
+
+
+@pytest.fixture(name='broker')
+def broker_fixture(monkeypatch: pytest.MonkeyPatch):
+    """A broker without the LISTEN connection, notifications are passed to it directly."""
+    broker = EventBroker(queue_max_size=2)
+
+    async def start():
+        pass
+
+    monkeypatch.setattr(broker, 'start', start)
+    return broker
+
+
+def send(broker: EventBroker, owner_id: uuid.UUID, id: str):
+    payload = {'owner_id': str(owner_id), 'entity': 'note', 'action': 'created', 'id': id}
+    broker._on_notification(None, 1, 'app_events', json.dumps(payload))
+
+
+@pytest.mark.asyncio
+async def test_broker_fans_out_events_of_the_owner(broker: EventBroker):
+    owner_id = uuid.uuid4()
+    async with broker.subscribe(owner_id) as first, broker.subscribe(owner_id) as second:
+        async with broker.subscribe(uuid.uuid4()) as other:
+            send(broker, owner_id, 'a')
+
+            expected = {'entity': 'note', 'action': 'created', 'id': 'a'}
+            assert first.get_nowait() == expected
+            assert second.get_nowait() == expected
+            assert other.empty()
+
+
+@pytest.mark.asyncio
+async def test_broker_ends_stream_of_slow_subscriber(broker: EventBroker):
+    """Should end the stream instead of dropping some of the events."""
+    owner_id = uuid.uuid4()
+    async with broker.subscribe(owner_id) as queue:
+        for id in ('a', 'b', 'c'):
+            send(broker, owner_id, id)
+
+        assert queue.get_nowait() is None
+        assert queue.empty()
+        send(broker, owner_id, 'd')
+        assert queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_stream_events(broker: EventBroker):
+    owner_id = uuid.uuid4()
+    stream = stream_events(broker, owner_id, ping_interval=0.01)
+
+    assert await anext(stream) == b': subscribed\n\n'
+    assert await anext(stream) == b': ping\n\n'
+
+    send(broker, owner_id, 'a')
+    event = await anext(stream)
+    assert event.startswith(b'event: note.created\ndata: ')
+    assert json.loads(event.split(b'data: ')[1]) == {
+        'entity': 'note',
+        'action': 'created',
+        'id': 'a',
+    }
+
+    await broker.close()
+    assert await anext(stream) == b'event: resync\ndata: {}\n\n'
+    with pytest.raises(StopAsyncIteration):
+        await anext(stream)
+
+
+@pytest.mark.asyncio
+async def test_notify_after_commit(session: AsyncSession):
+    """Listening workers should get the events once the transaction commits."""
+    broker = EventBroker()
+    owner_id = uuid.uuid4()
+    note_ids = [uuid.uuid4(), uuid.uuid4()]
+    try:
+        async with broker.subscribe(owner_id) as queue:
+            await notify(session, owner_id, 'note', EventAction.UPDATED, note_ids)
+            await asyncio.sleep(0.1)
+            assert queue.empty()
+
+            await session.commit()
+            events = [await asyncio.wait_for(queue.get(), 5) for _ in note_ids]
+    finally:
+        await broker.close()
+
+    assert events == [{'entity': 'note', 'action': 'updated', 'id': str(x)} for x in note_ids]
@@ -0,0 +1,211 @@
+import asyncio
+import sqlite3
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from httpx import ASGITransport, AsyncClient
+from prometheus_client import REGISTRY
+from pydantic import TypeAdapter
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.util import greenlet_spawn
+
+from app.core.config import settings
+from app.core.db import InstrumentedPool, PreparedStatementCache, run_transaction
+from app.core.response import create_json_response
+from app.middlewares.metrics import UNMATCHED_PATH, MetricsMiddleware
+from app.slices.tag.models import TagPublic
+
+metrics_app = FastAPI()
+metrics_app.add_middleware(MetricsMiddleware)
+
+
+@metrics_app.get('/items/{id}')
+def read_item(id: int):
+    return {'id': id}
+
+
+@metrics_app.get('/stream')
+def stream():
+    async def generate():
+        for x in range(3):
+            await asyncio.sleep(0.05)
+            yield str(x)
+
+    return StreamingResponse(generate())
+
+
+def get_sample_value(name: str, path: str, status_code: int = 200) -> float:
+    labels = {
+        'app': settings.APP_NAME,
+        'path': path,
+        'method': 'GET',
+        'status_code': str(status_code),
+    }
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.asyncio
+async def test_metrics_are_labeled_with_path_template():
+    """Requests to different IDs should share one time series."""
+    count = get_sample_value('app_http_request_count_total', '/items/{id}')
+    unmatched_count = get_sample_value('app_http_request_count_total', UNMATCHED_PATH, 404)
+
+    async with AsyncClient(transport=ASGITransport(app=metrics_app), base_url='http://test') as c:
+        for id in (1, 2):
+            response = await c.get(f'/items/{id}')
+            assert response.status_code == 200
+
+        response = await c.get('/missing')
+        assert response.status_code == 404
+
+    assert get_sample_value('app_http_request_count_total', '/items/{id}') == count + 2
+    assert get_sample_value('app_http_request_count_total', '/items/1') == 0
+    assert (
+        get_sample_value('app_http_request_count_total', UNMATCHED_PATH, 404) == unmatched_count + 1
+    )
+
+
+@pytest.mark.asyncio
+async def test_metrics_include_streaming_response_body():
+    """The duration should include sending the whole streaming body."""
+    duration = get_sample_value('app_http_request_duration_seconds_sum', '/stream')
+
+    async with AsyncClient(transport=ASGITransport(app=metrics_app), base_url='http://test') as c:
+        response = await c.get('/stream')
+        assert response.text == '012'
+
+    assert get_sample_value('app_http_request_duration_seconds_sum', '/stream') - duration >= 0.15
+
+
+def test_create_json_response_measures_serialization():
+    labels = {'app': settings.APP_NAME, 'endpoint': 'test'}
+    name = 'app_response_serialization_duration_seconds_count'
+    count = REGISTRY.get_sample_value(name, labels) or 0
+
+    tag = {'id': '0b5ba3ff-4fc6-4bd5-8f5a-b0e5e86e1ef0', 'name': 'tag'}
+    response = create_json_response(TypeAdapter(list[TagPublic]), [tag], 'test', {'X-Test': '1'})
+
+    assert response.body == b'[{"id":"0b5ba3ff-4fc6-4bd5-8f5a-b0e5e86e1ef0","name":"tag"}]'
+    assert response.headers['X-Test'] == '1'
+    assert REGISTRY.get_sample_value(name, labels) == count + 1
+
+
+def get_app_sample_value(name: str) -> float:
+    return REGISTRY.get_sample_value(name, {'app': settings.APP_NAME}) or 0
+
+
+@pytest.mark.asyncio
+async def test_pool_gauges():
+    """Should count connections in use and connections beyond the pool size."""
+    pool = InstrumentedPool(lambda: sqlite3.connect(':memory:'), pool_size=1, max_overflow=1)
+    checkout_count = get_app_sample_value('app_db_pool_checkout_wait_seconds_count')
+
+    def use_connections():
+        first = pool.connect()
+        second = pool.connect()
+        assert get_app_sample_value('app_db_pool_checked_out_connections') == 2
+        assert get_app_sample_value('app_db_pool_overflow_connections') == 1
+
+        first.close()
+        second.close()
+        assert get_app_sample_value('app_db_pool_checked_out_connections') == 0
+
+    # The pool of the async engine expects to run in a greenlet.
+    await greenlet_spawn(use_connections)
+    pool.dispose()
+
+    assert get_app_sample_value('app_db_pool_checkout_wait_seconds_count') == checkout_count + 2
+
+
+def test_prepared_statement_cache_counts_hits_and_misses():
+    hit_count = get_app_sample_value('app_db_prepared_statement_cache_hit_count_total')
+    miss_count = get_app_sample_value('app_db_prepared_statement_cache_miss_count_total')
+
+    cache = PreparedStatementCache(10)
+    # The same calls as the asyncpg adapter makes.
+    for _ in range(3):
+        if 'SELECT 1' in cache:
+            cache['SELECT 1']
+        else:
+            cache['SELECT 1'] = 'statement'
+
+    assert get_app_sample_value('app_db_prepared_statement_cache_hit_count_total') == hit_count + 2
+    assert (
+        get_app_sample_value('app_db_prepared_statement_cache_miss_count_total') == miss_count + 1
+    )
+
+
+class SQLStateError(Exception):
+    def __init__(self, sqlstate: str):
+        self.sqlstate = sqlstate
+
+
+class FakeSession:
+    def __init__(self):
+        self.commit_count = 0
+        self.rollback_count = 0
+
+    def in_transaction(self):
+        return False
+
+    async def commit(self):
+        self.commit_count += 1
+
+    async def rollback(self):
+        self.rollback_count += 1
+
+
+def get_retry_sample_value(name: str, sqlstate: str) -> float:
+    return REGISTRY.get_sample_value(name, {'app': settings.APP_NAME, 'sqlstate': sqlstate}) or 0
+
+
+@pytest.mark.asyncio
+async def test_run_transaction(monkeypatch: pytest.MonkeyPatch):
+    """Should run the work again after a serialization failure or a deadlock."""
+    monkeypatch.setattr(settings, 'DB_TRANSACTION_RETRY_BACKOFF', 0)
+    retry_count = get_retry_sample_value('app_db_transaction_retry_count_total', '40001')
+    errors = [SQLStateError('40001'), SQLStateError('40P01')]
+
+    async def work():
+        if errors:
+            raise DBAPIError('UPDATE', None, errors.pop(0))
+        return 'ok'
+
+    session = FakeSession()
+    assert await run_transaction(session, work) == 'ok'
+    assert session.rollback_count == 2
+    assert session.commit_count == 1
+    assert get_retry_sample_value('app_db_transaction_retry_count_total', '40001') == (
+        retry_count + 1
+    )
+
+
+@pytest.mark.asyncio
+async def test_run_transaction_gives_up(monkeypatch: pytest.MonkeyPatch):
+    """Should return 503 after the last attempt and never retry other errors."""
+    monkeypatch.setattr(settings, 'DB_TRANSACTION_RETRY_BACKOFF', 0)
+    exhausted_count = get_retry_sample_value(
+        'app_db_transaction_retry_exhausted_count_total', '40001'
+    )
+    attempt_count = 0
+    sqlstate = '40001'
+
+    async def work():
+        nonlocal attempt_count
+        attempt_count += 1
+        raise DBAPIError('UPDATE', None, SQLStateError(sqlstate))
+
+    with pytest.raises(HTTPException) as exc_info:
+        await run_transaction(FakeSession(), work)
+    assert exc_info.value.status_code == 503
+    assert attempt_count == settings.DB_TRANSACTION_MAX_ATTEMPTS
+    assert get_retry_sample_value('app_db_transaction_retry_exhausted_count_total', '40001') == (
+        exhausted_count + 1
+    )
+
+    attempt_count = 0
+    sqlstate = '23505'
+    with pytest.raises(DBAPIError):
+        await run_transaction(FakeSession(), work)
+    assert attempt_count == 1
@@ -1,17 +1,30 @@
+import asyncio
+import datetime as dt
+import json
 import uuid
 from collections.abc import Callable
 
 import numpy as np
 import pytest
 from httpx import AsyncClient
+from sqlalchemy import delete, insert, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
 
-from app.core.config import settings
-from app.slices.note.models import Note, NotePublic
-from app.slices.note.service import get_embedding
+from app.core.config import EmbeddingMode, settings
+from app.core.cursor import encode_cursor
+from app.slices.note.constants import (
+    NEXT_CURSOR_HEADER,
+    NOTE_PAGE_LIMIT_MAX,
+    SENTENCE_TRANSFORMERS_EMBEDDING_SIZE,
+)
+from app.slices.note.encoder import Encoder
+from app.slices.note.models import Note, NoteChunk, NotePublic, NotesRead, note_tag_m2m
+from app.slices.note.service import embed_pending_notes, get_embedding, search_notes
 from app.slices.tag.models import Tag, TagPublic
 
 URL_NOTES = f'{settings.API_V1_STR}/notes/'
+URL_TAGS = f'{settings.API_V1_STR}/tags/'
 
 
 @pytest.mark.asyncio
@@ -114,7 +127,7 @@ async def test_create_note_embedding(
     session: AsyncSession,
     client: AsyncClient,
     current_user_id: uuid.UUID,
-    st,
+    encoder: Encoder,
 ):
     create_values = {
         'name': 'name',
@@ -126,7 +139,8 @@ async def test_create_note_embedding(
 
     data = response.json()
     note = await session.get(Note, data['id'])
-    assert np.array_equal(note.embedding, st.encode('name. content'))
+    [embedding] = await encoder.encode(['name. content'])
+    assert np.array_equal(note.embedding, embedding)
 
 
 @pytest.mark.asyncio
@@ -169,14 +183,14 @@ async def test_update_note(
 async def test_update_note_embedding(
     session: AsyncSession,
     client: AsyncClient,
-    st,
+    encoder: Encoder,
     create_note: Callable,
 ):
     note = await create_note(name='name', content='content')
 
     new_name = 'My new name'
     new_content = 'My new content'
-    new_embedding = get_embedding(st, new_name, new_content)
+    new_embedding = await get_embedding(encoder, new_name, new_content)
 
     assert not np.array_equal(note.embedding, new_embedding)
 
@@ -190,6 +204,304 @@ async def test_update_note_embedding(
     assert np.array_equal(note.embedding, new_embedding)
 
 
+@pytest.mark.asyncio
+async def test_update_note_with_same_text(
+    client: AsyncClient,
+    create_note: Callable,
+    encoded_texts: list[str],
+):
+    """Should not run the model if the name and content did not actually change."""
+    note = await create_note(name='name', content='content')
+    encoded_texts.clear()
+
+    response = await client.patch(
+        URL_NOTES + str(note.id),
+        json={'name': 'name', 'content': 'content', 'tags': ['new tag']},
+    )
+    assert response.status_code == 204
+    assert encoded_texts == []
+
+
+@pytest.mark.asyncio
+async def test_create_note_with_same_text(
+    session: AsyncSession,
+    client: AsyncClient,
+    create_note: Callable,
+    encoded_texts: list[str],
+):
+    """Should reuse the embedding of another note with the same text."""
+    note = await create_note(name='name', content='content')
+    encoded_texts.clear()
+
+    response = await client.post(URL_NOTES, json={'name': 'name', 'content': 'content'})
+    assert response.status_code == 200
+    assert encoded_texts == []
+
+    new_note = await session.get(Note, response.json()['id'])
+    assert np.array_equal(new_note.embedding, note.embedding)
+
+
+@pytest.mark.asyncio
+async def test_create_note_with_async_embedding(
+    session: AsyncSession,
+    client: AsyncClient,
+    encoder: Encoder,
+    encoded_texts: list[str],
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """Should save the note without running the model and leave the embedding to the worker."""
+    monkeypatch.setattr(settings, 'EMBEDDING_MODE', EmbeddingMode.ASYNC)
+
+    response = await client.post(URL_NOTES, json={'name': 'name', 'content': 'content'})
+    assert response.status_code == 200
+    assert encoded_texts == []
+
+    note = await session.get(Note, response.json()['id'])
+    assert note.embedding is None
+
+    assert await embed_pending_notes(session, encoder, limit=10) == 1
+    await session.commit()
+    assert await embed_pending_notes(session, encoder, limit=10) == 0
+
+    await session.refresh(note)
+    [embedding] = await encoder.encode(['name. content'])
+    assert np.array_equal(note.embedding, embedding)
+
+
+@pytest.mark.asyncio
+async def test_embed_note_edited_while_embedding(
+    session: AsyncSession,
+    client: AsyncClient,
+    db_engine,
+    encoder: Encoder,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """
+    Should not keep the note locked while the model runs. The embedding of the old text is not
+    saved, the job stays for the new text.
+    """
+    monkeypatch.setattr(settings, 'EMBEDDING_MODE', EmbeddingMode.ASYNC)
+    response = await client.post(URL_NOTES, json={'name': 'name', 'content': 'content'})
+    note_id = response.json()['id']
+
+    encode = encoder.encode
+    edited = False
+
+    async def encode_and_edit(texts: list[str]) -> list[list[float]]:
+        nonlocal edited
+        if not edited:
+            edited = True
+            # Waits for the worker if it keeps a transaction open.
+            response = await asyncio.wait_for(
+                client.patch(URL_NOTES + note_id, json={'content': 'new content'}),
+                timeout=5,
+            )
+            assert response.status_code == 204
+        return await encode(texts)
+
+    monkeypatch.setattr(encoder, 'encode', encode_and_edit)
+
+    sm = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+    async with sm() as worker_session:
+        assert await embed_pending_notes(worker_session, encoder, limit=10) == 0
+        note = await session.get(Note, note_id, populate_existing=True)
+        assert note.embedding is None
+
+        assert await embed_pending_notes(worker_session, encoder, limit=10) == 1
+
+    await session.refresh(note)
+    [embedding] = await encode(['name. new content'])
+    assert np.array_equal(note.embedding, embedding)
+
+
+@pytest.mark.asyncio
+async def test_create_notes_bulk(
+    session: AsyncSession,
+    client: AsyncClient,
+    create_tag: Callable,
+    encoder: Encoder,
+    encoded_texts: list[str],
+):
+    """Should create the valid notes with one model call and report the invalid ones."""
+    tag = await create_tag(name='work')
+    encoded_texts.clear()
+
+    response = await client.post(
+        URL_NOTES + 'bulk',
+        json=[
+            {'name': 'first', 'content': 'content', 'tags': ['work', 'new']},
+            {'name': '', 'content': 'content'},
+            {'name': 'second', 'content': 'content', 'tags': ['new']},
+        ],
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data['ids'][1] is None
+    assert [x['index'] for x in data['errors']] == [1]
+    assert encoded_texts == ['first. content', 'second. content']
+
+    first = await session.get(Note, data['ids'][0])
+    second = await session.get(Note, data['ids'][2])
+    assert (first.name, second.name) == ('first', 'second')
+    assert {x.name for x in first.tags} == {'work', 'new'}
+    assert tag.id in {x.id for x in first.tags}
+    assert [x.id for x in second.tags] == [x.id for x in first.tags if x.name == 'new']
+
+    [embedding] = await encoder.encode(['first. content'])
+    assert np.array_equal(first.embedding, embedding)
+
+
+@pytest.mark.asyncio
+async def test_embed_outside_transaction(
+    session: AsyncSession,
+    client: AsyncClient,
+    encoder: Encoder,
+    create_note: Callable,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """Should run the model with no transaction of the request open."""
+    note = await create_note(name='name', content='content')
+    encode = encoder.encode
+    in_transaction = []
+
+    async def encode_spy(texts: list[str]) -> list[list[float]]:
+        in_transaction.append(session.in_transaction())
+        return await encode(texts)
+
+    monkeypatch.setattr(encoder, 'encode', encode_spy)
+
+    response = await client.patch(URL_NOTES + str(note.id), json={'content': 'new content'})
+    assert response.status_code == 204
+    response = await client.post(URL_NOTES + 'bulk', json=[{'name': 'bulk', 'content': 'note'}])
+    assert response.status_code == 200
+    assert in_transaction == [False, False]
+
+
+@pytest.mark.asyncio
+async def test_create_notes_bulk_of_long_notes(session: AsyncSession, client: AsyncClient):
+    """Should split more long notes than the encoder queue holds jobs."""
+    count = settings.ENCODER_QUEUE_MAX_SIZE + 1
+    response = await client.post(
+        URL_NOTES + 'bulk',
+        json=[{'name': f'note {i}', 'content': f'long content {i} ' * 50} for i in range(count)],
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data['errors'] == []
+
+    note_ids = [uuid.UUID(x) for x in data['ids']]
+    result = await session.execute(select(NoteChunk.note_id).where(NoteChunk.note_id.in_(note_ids)))
+    assert len(set(result.scalars())) == count
+
+
+@pytest.mark.asyncio
+async def test_create_notes_bulk_ndjson(session: AsyncSession, client: AsyncClient):
+    """Should create a note of each valid line."""
+    response = await client.post(
+        URL_NOTES + 'bulk',
+        content='{"name": "first", "content": "content"}\nnot json\n\n{"name": "second"}\n',
+        headers={'Content-Type': 'application/x-ndjson'},
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [x is not None for x in data['ids']] == [True, False, False]
+    assert [x['index'] for x in data['errors']] == [1, 2]
+
+    note = await session.get(Note, data['ids'][0])
+    assert note.name == 'first'
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('content', ('not json', '{"name": "note"}'))
+async def test_create_notes_bulk_with_invalid_body(client: AsyncClient, content: str):
+    response = await client.post(
+        URL_NOTES + 'bulk', content=content, headers={'Content-Type': 'application/json'}
+    )
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_update_note_with_async_embedding(
+    session: AsyncSession,
+    client: AsyncClient,
+    encoder: Encoder,
+    create_note: Callable,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """
+    Should keep the old embedding until the worker embeds the new text. Edits before that
+    share one job.
+    """
+    note = await create_note(name='name', content='content')
+    old_embedding = note.embedding
+    monkeypatch.setattr(settings, 'EMBEDDING_MODE', EmbeddingMode.ASYNC)
+
+    for content in ('new content', 'newer content'):
+        response = await client.patch(URL_NOTES + str(note.id), json={'content': content})
+        assert response.status_code == 204
+
+    await session.refresh(note)
+    assert np.array_equal(note.embedding, old_embedding)
+
+    assert await embed_pending_notes(session, encoder, limit=10) == 1
+    await session.commit()
+    assert await embed_pending_notes(session, encoder, limit=10) == 0
+
+    await session.refresh(note)
+    [embedding] = await encoder.encode(['name. newer content'])
+    assert np.array_equal(note.embedding, embedding)
+
+
+LONG_CONTENT = ' '.join(
+    f'Paragraph {i} is about cooking pasta, boiling water and adding salt.' for i in range(60)
+)
+
+
+@pytest.mark.asyncio
+async def test_create_long_note(
+    session: AsyncSession,
+    client: AsyncClient,
+    create_note: Callable,
+):
+    """Should embed a long note by chunks, so the text at its end is searchable too."""
+    await create_note(name='Unrelated', content='Deploying FastAPI with Docker Compose')
+    tail = 'The final chapter explains how to fix a flat bicycle tyre.'
+    response = await client.post(
+        URL_NOTES, json={'name': 'Cookbook', 'content': f'{LONG_CONTENT} {tail}'}
+    )
+    assert response.status_code == 200
+
+    result = await session.scalars(
+        select(NoteChunk).where(NoteChunk.note_id == response.json()['id'])
+    )
+    assert len(result.all()) > 1
+
+    response = await client.get(URL_NOTES, params={'q': 'bicycle tyre repair'})
+    assert response.status_code == 200
+    assert [x['name'] for x in response.json()][:1] == ['Cookbook']
+
+
+@pytest.mark.asyncio
+async def test_update_long_note_tail(
+    session: AsyncSession,
+    client: AsyncClient,
+    create_note: Callable,
+    encoded_texts: list[str],
+):
+    """Should only encode chunks whose text changed."""
+    note = await create_note(name='Cookbook', content=f'{LONG_CONTENT} Enjoy your meal.')
+    result = await session.scalars(select(NoteChunk).where(NoteChunk.note_id == note.id))
+    chunk_count = len(result.all())
+    encoded_texts.clear()
+
+    response = await client.patch(
+        URL_NOTES + str(note.id),
+        json={'content': f'{LONG_CONTENT} Bon appetit!'},
+    )
+    assert response.status_code == 204
+    assert 0 < len(encoded_texts) < chunk_count
+
+
 @pytest.mark.asyncio
 async def test_update_note_with_new_tag(
     session: AsyncSession,
@@ -252,6 +564,85 @@ async def test_read_notes_with_offset_and_limit(
         assert NotePublic.model_validate(note) == NotePublic.model_validate(data)
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize('mode', ('semantic', 'keyword', 'hybrid'))
+async def test_read_notes_with_too_large_limit(client: AsyncClient, mode: str):
+    params = {'q': 'note', 'mode': mode, 'limit': NOTE_PAGE_LIMIT_MAX + 1}
+    response = await client.get(URL_NOTES, params=params)
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_read_notes_with_large_limit(client: AsyncClient):
+    """Should not cap the limit of listing, only of search."""
+    response = await client.get(URL_NOTES, params={'limit': NOTE_PAGE_LIMIT_MAX + 1})
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('q, mode', ((None, None), ('note', None), ('note', 'keyword')))
+async def test_read_notes_with_cursor(
+    client: AsyncClient,
+    create_note: Callable,
+    q: str | None,
+    mode: str | None,
+):
+    """Pages fetched by cursors should add up to the full result, without duplicates."""
+    for i in range(5):
+        await create_note(name=f'note {i}', content=f'content of note {i}')
+
+    params = {'limit': NOTE_PAGE_LIMIT_MAX}
+    if q:
+        params['q'] = q
+    if mode:
+        params['mode'] = mode
+
+    response = await client.get(URL_NOTES, params=params)
+    assert response.status_code == 200
+    assert NEXT_CURSOR_HEADER not in response.headers
+    expected_ids = [x['id'] for x in response.json()]
+    assert len(expected_ids) == 5
+
+    ids = []
+    params['limit'] = 2
+    while True:
+        response = await client.get(URL_NOTES, params=params)
+        assert response.status_code == 200
+        ids.extend(x['id'] for x in response.json())
+
+        if NEXT_CURSOR_HEADER not in response.headers:
+            break
+        params['cursor'] = response.headers[NEXT_CURSOR_HEADER]
+
+    assert ids == expected_ids
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    'params',
+    (
+        {'cursor': 'not a cursor'},
+        {'cursor': encode_cursor({'id': str(uuid.uuid4())})},
+        {'cursor': encode_cursor({'distance': 0.5, 'id': str(uuid.uuid4())})},
+        {'cursor': encode_cursor({'created_at': '2025-01-01T00:00:00+00:00', 'id': 'x'})},
+        {
+            'cursor': encode_cursor(
+                {'created_at': '2025-01-01T00:00:00+00:00', 'id': str(uuid.uuid4())}
+            ),
+            'offset': 1,
+        },
+        {
+            'q': 'note',
+            'mode': 'hybrid',
+            'cursor': encode_cursor({'rank': 0.5, 'id': str(uuid.uuid4())}),
+        },
+    ),
+)
+async def test_read_notes_with_invalid_cursor(client: AsyncClient, params: dict):
+    response = await client.get(URL_NOTES, params=params)
+    assert response.status_code == 422
+
+
 @pytest.mark.asyncio
 async def test_read_notes_semantic_search(client: AsyncClient, create_note: Callable):
     for name, content in (
@@ -270,12 +661,427 @@ async def test_read_notes_semantic_search(client: AsyncClient, create_note: Call
 
 
 @pytest.mark.asyncio
-async def test_delete_note(
+async def test_semantic_search_of_small_owner(
     session: AsyncSession,
+    encoder: Encoder,
+    current_user_id: uuid.UUID,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """
+    Should find the notes of an owner holding a small share of the index, as long as the scan
+    may visit enough index tuples. The notes of another owner are closer to the query.
+    """
+
+    def get_vector(*values: float) -> list[float]:
+        return [*values, *[0.0] * (SENTENCE_TRANSFORMERS_EMBEDDING_SIZE - len(values))]
+
+    now = dt.datetime.now(dt.timezone.utc)
+    other_owner_id = uuid.uuid4()
+    notes = []
+    chunks = []
+    for i in range(500):
+        owner_id = current_user_id if i < 3 else other_owner_id
+        embedding = get_vector(1, 0.001 * i, 0.5 if owner_id == current_user_id else 0)
+        note_id = uuid.uuid4()
+        notes.append(
+            {
+                'id': note_id,
+                'name': f'note {i}',
+                'content': '',
+                'owner_id': owner_id,
+                'embedding': embedding,
+                'embedding_source_hash': 'hash',
+                'created_at': now,
+                'updated_at': now,
+            }
+        )
+        chunks.append(
+            {
+                'note_id': note_id,
+                'position': 0,
+                'text_hash': 'hash',
+                'owner_id': owner_id,
+                'embedding': embedding,
+            }
+        )
+    await session.execute(insert(Note), notes)
+    await session.execute(insert(NoteChunk), chunks)
+    await session.commit()
+
+    async def encode_query(query: str) -> list[float]:
+        return get_vector(1)
+
+    monkeypatch.setattr(encoder, 'encode_query', encode_query)
+
+    async def search() -> list[dict]:
+        # A table this small would be sorted instead of scanned by the index.
+        await session.execute(text('SET LOCAL enable_seqscan = off'))
+        await session.execute(text('SET LOCAL enable_sort = off'))
+        found_notes, _ = await search_notes(session, current_user_id, encoder, NotesRead(q='q'))
+        await session.rollback()
+        return found_notes
+
+    monkeypatch.setattr(settings, 'DB_HNSW_MAX_SCAN_TUPLES', 100)
+    assert len(await search()) < 3
+
+    monkeypatch.setattr(settings, 'DB_HNSW_MAX_SCAN_TUPLES', 1000)
+    assert len(await search()) == 3
+
+
+@pytest.mark.asyncio
+async def test_read_notes_keyword_search(
+    client: AsyncClient,
+    create_note: Callable,
+    encoded_texts: list[str],
+):
+    """Should find exact identifiers by the full-text index without encoding the query."""
+    await create_note(name='Deploy failure', content='Build XK-42-ab failed on the runner')
+    await create_note(name='Deploy success', content='Build XK-43-cd passed on the runner')
+    encoded_texts.clear()
+
+    response = await client.get(URL_NOTES, params={'q': 'XK-42-ab', 'mode': 'keyword'})
+    assert response.status_code == 200
+    assert [x['name'] for x in response.json()] == ['Deploy failure']
+    assert encoded_texts == []
+
+
+@pytest.mark.asyncio
+async def test_read_notes_hybrid_search(client: AsyncClient, create_note: Callable):
+    """Should return notes found by either of the searches."""
+    for name, content in (
+        ('Fuzzy Search', 'Implementing fuzzy search using pg_trgm extension in Postgres'),
+        ('Deploy failure', 'Build XK-42-ab failed on the runner'),
+        ('Groceries', 'milk, eggs, bread'),
+    ):
+        await create_note(name=name, content=content)
+
+    # Found by the keyword search only.
+    response = await client.get(URL_NOTES, params={'q': 'XK-42-ab', 'mode': 'hybrid'})
+    assert response.status_code == 200
+    assert response.json()[0]['name'] == 'Deploy failure'
+    assert NEXT_CURSOR_HEADER not in response.headers
+
+    # Found by the semantic search only.
+    response = await client.get(
+        URL_NOTES, params={'q': 'approximate matching of text', 'mode': 'hybrid'}
+    )
+    assert response.status_code == 200
+    assert 'Fuzzy Search' in [x['name'] for x in response.json()]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('q, mode', ((None, None), ('note', 'semantic'), ('note', 'keyword')))
+@pytest.mark.parametrize(
+    'filters, expected_names',
+    (
+        ({'tags': ['work', 'urgent']}, ['note 1']),
+        ({'any_tags': ['urgent', 'home']}, ['note 1', 'note 2', 'note 3']),
+        ({'exclude_tags': ['urgent']}, ['note 0', 'note 3', 'note 4']),
+        ({'tags': ['work'], 'exclude_tags': ['urgent']}, ['note 0']),
+        ({'tags': ['missing']}, []),
+    ),
+)
+async def test_read_notes_with_tag_filters(
     client: AsyncClient,
     create_note: Callable,
+    create_tag: Callable,
+    q: str | None,
+    mode: str | None,
+    filters: dict,
+    expected_names: list[str],
 ):
+    """Should return full pages of the matching notes only."""
+    work = await create_tag(name='work')
+    urgent = await create_tag(name='urgent')
+    home = await create_tag(name='home')
+    for i, tags in enumerate(([work], [work, urgent], [urgent], [home], [])):
+        await create_note(name=f'note {i}', content=f'content of note {i}', tags=tags)
+
+    params = {**filters, 'limit': 2}
+    if q:
+        params['q'] = q
+    if mode:
+        params['mode'] = mode
+
+    names = []
+    while True:
+        response = await client.get(URL_NOTES, params=params)
+        assert response.status_code == 200
+        page = [x['name'] for x in response.json()]
+        names.extend(page)
+
+        if NEXT_CURSOR_HEADER not in response.headers:
+            break
+        assert len(page) == 2
+        params['cursor'] = response.headers[NEXT_CURSOR_HEADER]
+
+    assert sorted(names) == expected_names
+
+
+@pytest.mark.asyncio
+async def test_read_notes_with_fields(client: AsyncClient, create_note: Callable):
+    """Should return only the requested fields."""
+    note = await create_note(name='note', content='content of the note')
+
+    response = await client.get(URL_NOTES, params={'fields': ['name'], 'snippet_length': 10})
+    assert response.status_code == 200
+    assert response.json() == [{'id': str(note.id), 'name': 'note', 'snippet': 'content of'}]
+
+
+@pytest.mark.asyncio
+async def test_read_notes_keyword_search_snippet(client: AsyncClient, create_note: Callable):
+    """Should cut the snippet around the matched words."""
+    content = ' '.join(f'word{i}' for i in range(200)) + ' XK-42-ab failed'
+    await create_note(name='Deploy failure', content=content)
+
+    response = await client.get(
+        URL_NOTES,
+        params={'q': 'XK-42-ab', 'mode': 'keyword', 'fields': ['name'], 'snippet_length': 60},
+    )
+    assert response.status_code == 200
+    [data] = response.json()
+    assert set(data) == {'id', 'name', 'snippet'}
+    assert 0 < len(data['snippet']) <= 60
+    assert not content.startswith(data['snippet'])
+
+
+@pytest.mark.asyncio
+async def test_read_similar_notes(
+    client: AsyncClient,
+    create_note: Callable,
+    create_tag: Callable,
+    encoded_texts: list[str],
+):
+    """Should rank notes by their stored embeddings without running the model."""
+    archived = await create_tag(name='archived')
+    setup = await create_note(name='FastAPI Setup', content='Configure FastAPI with PostgreSQL')
+    await create_note(name='Docker Deploy', content='Deploy FastAPI and PostgreSQL with Docker')
+    await create_note(name='FastAPI Tips', content='Tips for FastAPI apps', tags=[archived])
+    await create_note(name='Groceries', content='milk, eggs, bread')
+    encoded_texts.clear()
+
+    response = await client.get(f'{URL_NOTES}{setup.id}/similar', params={'limit': 2})
+    assert response.status_code == 200
+    names = [x['name'] for x in response.json()]
+    assert 'FastAPI Setup' not in names
+    assert 'Docker Deploy' in names
+    assert 'Groceries' not in names
+
+    response = await client.get(
+        f'{URL_NOTES}{setup.id}/similar', params={'exclude_tags': ['archived']}
+    )
+    assert response.status_code == 200
+    assert 'FastAPI Tips' not in [x['name'] for x in response.json()]
+    assert encoded_texts == []
+
+
+@pytest.mark.asyncio
+async def test_read_similar_notes_batch(client: AsyncClient, create_note: Callable):
+    """Should return the similar notes of every note in the order of the ids."""
+    setup = await create_note(name='FastAPI Setup', content='Configure FastAPI with PostgreSQL')
+    deploy = await create_note(name='Docker Deploy', content='Deploy FastAPI with Docker')
+
+    response = await client.get(
+        URL_NOTES + 'similar', params={'ids': [str(deploy.id), str(setup.id)]}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [x['id'] for x in data] == [str(deploy.id), str(setup.id)]
+    assert [x['name'] for x in data[0]['notes']] == ['FastAPI Setup']
+    assert [x['name'] for x in data[1]['notes']] == ['Docker Deploy']
+
+
+@pytest.mark.asyncio
+async def test_read_similar_notes_of_missing_note(client: AsyncClient, create_note: Callable):
     note = await create_note()
+    note_id = uuid.uuid4()
+
+    response = await client.get(URL_NOTES + 'similar', params={'ids': [str(note.id), str(note_id)]})
+    assert response.status_code == 404
+    assert response.json() == {'detail': f'Note {note_id} was not found.'}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('params', ({}, {'tags': True, 'embeddings': True}))
+async def test_export_notes(
+    client: AsyncClient,
+    create_note: Callable,
+    create_tag: Callable,
+    params: dict,
+):
+    """Should stream all notes of the user as NDJSON, the oldest first."""
+    tag = await create_tag(name='work')
+    notes = [
+        await create_note(name=f'note {i}', content=f'content {i}', tags=[tag] if i else [])
+        for i in range(3)
+    ]
+
+    response = await client.get(URL_NOTES + 'export', params=params)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/x-ndjson'
+
+    lines = [json.loads(x) for x in response.text.splitlines()]
+    assert [x['id'] for x in lines] == [str(x.id) for x in notes]
+    assert [x['name'] for x in lines] == ['note 0', 'note 1', 'note 2']
+    if params:
+        assert [len(x['tags']) for x in lines] == [0, 1, 1]
+        assert np.allclose(lines[0]['embedding'], notes[0].embedding)
+    else:
+        assert all('tags' not in x and 'embedding' not in x for x in lines)
+
+
+@pytest.mark.asyncio
+async def test_read_changes(
+    client: AsyncClient,
+    create_note: Callable,
+    create_tag: Callable,
+):
+    """Should return what changed since the token, tag links and deletions included."""
+    tag = await create_tag(name='work')
+    first = await create_note(name='first')
+    second = await create_note(name='second')
+
+    response = await client.get(URL_NOTES + 'changes')
+    assert response.status_code == 200
+    data = response.json()
+    assert [x['id'] for x in data['tags']] == [str(tag.id)]
+    assert [x['id'] for x in data['notes']] == [str(first.id), str(second.id)]
+    assert data['deleted'] == []
+    assert data['has_more'] is False
+
+    response = await client.get(URL_NOTES + 'changes', params={'since': data['next_token']})
+    assert response.status_code == 200
+    assert response.json()['notes'] == []
+
+    response = await client.patch(URL_NOTES + str(first.id), json={'tags': ['work']})
+    assert response.status_code == 204
+    response = await client.delete(URL_NOTES + str(second.id))
+    assert response.status_code == 204
+
+    response = await client.get(URL_NOTES + 'changes', params={'since': data['next_token']})
+    assert response.status_code == 200
+    data = response.json()
+    assert [x['id'] for x in data['notes']] == [str(first.id)]
+    assert [x['name'] for x in data['notes'][0]['tags']] == ['work']
+    assert data['deleted'] == [{'entity': 'note', 'id': str(second.id)}]
+
+
+@pytest.mark.asyncio
+async def test_read_changes_by_pages(
+    client: AsyncClient,
+    create_note: Callable,
+):
+    """Pages fetched by tokens should add up to all changes, without duplicates."""
+    notes = [await create_note(name=f'note {i}') for i in range(5)]
+
+    ids = []
+    params = {'limit': 2}
+    while True:
+        response = await client.get(URL_NOTES + 'changes', params=params)
+        assert response.status_code == 200
+        data = response.json()
+        ids.extend(x['id'] for x in data['notes'])
+        params['since'] = data['next_token']
+        if not data['has_more']:
+            break
+
+    assert ids == [str(x.id) for x in notes]
+
+
+@pytest.mark.asyncio
+async def test_read_changes_of_late_commit(
+    client: AsyncClient,
+    db_engine,
+    current_user_id: uuid.UUID,
+    create_tag: Callable,
+):
+    """A change committed after newer ones should not slip behind a token."""
+    sm = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+    async with sm() as late_session:
+        late_session.add(Tag(name='late', owner_id=current_user_id))
+        await late_session.flush()
+        await create_tag(name='early')
+
+        response = await client.get(URL_NOTES + 'changes')
+        assert response.status_code == 200
+        data = response.json()
+        assert data['tags'] == []
+
+        await late_session.commit()
+
+    response = await client.get(URL_NOTES + 'changes', params={'since': data['next_token']})
+    assert response.status_code == 200
+    assert [x['name'] for x in response.json()['tags']] == ['late', 'early']
+
+
+@pytest.mark.asyncio
+async def test_read_changes_after_tag_delete(
+    client: AsyncClient,
+    create_note: Callable,
+    create_tag: Callable,
+):
+    """Notes should change when they lose a deleted tag."""
+    tag = await create_tag(name='work')
+    note = await create_note(tags=[tag])
+    other_note = await create_note()
+
+    response = await client.get(URL_NOTES + 'changes')
+    assert response.status_code == 200
+    token = response.json()['next_token']
+
+    response = await client.delete(f'{URL_TAGS}{tag.id}')
+    assert response.status_code == 204
+
+    response = await client.get(URL_NOTES + 'changes', params={'since': token})
+    assert response.status_code == 200
+    data = response.json()
+    assert [x['id'] for x in data['notes']] == [str(note.id)]
+    assert data['notes'][0]['tags'] == []
+    assert str(other_note.id) not in [x['id'] for x in data['notes']]
+    assert data['deleted'] == [{'entity': 'tag', 'id': str(tag.id)}]
+
+
+@pytest.mark.asyncio
+async def test_read_changes_of_note_deleted_while_reading(
+    client: AsyncClient,
+    db_engine,
+    create_note: Callable,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """A note deleted after the changes were read should still be returned from the snapshot."""
+    note = await create_note(name='note')
+    scalars = AsyncSession.scalars
+    sm = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def scalars_after_delete(self, *args, **kwargs):
+        async with sm() as other_session:
+            await other_session.execute(delete(Note).where(Note.id == note.id))
+            await other_session.commit()
+        return await scalars(self, *args, **kwargs)
+
+    monkeypatch.setattr(AsyncSession, 'scalars', scalars_after_delete)
+    response = await client.get(URL_NOTES + 'changes')
+    monkeypatch.undo()
+
+    assert response.status_code == 200
+    assert [x['id'] for x in response.json()['notes']] == [str(note.id)]
+
+
+@pytest.mark.asyncio
+async def test_read_changes_with_invalid_token(client: AsyncClient):
+    response = await client.get(URL_NOTES + 'changes', params={'since': 'not a token'})
+    assert response.status_code == 422
+
+
+@pytest.mark.asyncio
+async def test_delete_note(
+    session: AsyncSession,
+    client: AsyncClient,
+    create_note: Callable,
+    create_tag: Callable,
+):
+    tag = await create_tag()
+    note = await create_note(tags=[tag])
     assert note == await session.get(Note, note.id)
 
     response = await client.delete(URL_NOTES + str(note.id))
@@ -283,6 +1089,30 @@ async def test_delete_note(
 
     assert None is await session.get(Note, note.id)
 
+    # Removed by the database cascades.
+    result = await session.scalars(select(NoteChunk).where(NoteChunk.note_id == note.id))
+    assert result.all() == []
+    result = await session.scalars(
+        select(note_tag_m2m.c.note_id).where(note_tag_m2m.c.tag_id == tag.id)
+    )
+    assert result.all() == []
+
+
+@pytest.mark.asyncio
+async def test_delete_note_of_other_owner(
+    session: AsyncSession,
+    client: AsyncClient,
+    create_note: Callable,
+):
+    """Should return 403 and keep the note."""
+    note = await create_note(owner_id=uuid.uuid4())
+
+    response = await client.delete(URL_NOTES + str(note.id))
+    assert response.status_code == 403
+
+    result = await session.scalars(select(Note.id).where(Note.id == note.id))
+    assert result.all() == [note.id]
+
 
 @pytest.mark.asyncio
 async def test_delete_missing_note(client: AsyncClient):
@@ -1,12 +1,19 @@
+import asyncio
 import uuid
 from collections.abc import Callable
 
 import pytest
 from httpx import AsyncClient
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
 
 from app.core.config import settings
+from app.core.events import EventBroker
+from app.core.models import DeletedEntity, DeletionLog
+from app.slices.note.models import Note
 from app.slices.tag.models import Tag, TagPublic
+from app.slices.tag.service import get_or_create_tags
 
 URL_TAGS = f'{settings.API_V1_STR}/tags/'
 
@@ -64,6 +71,25 @@ async def test_delete_tag(session: AsyncSession, client: AsyncClient, create_tag
 
     assert None is await session.get(Tag, tag.id)
 
+    result = await session.scalars(select(DeletionLog).where(DeletionLog.entity_id == tag.id))
+    assert [x.entity for x in result] == [DeletedEntity.TAG]
+
+
+@pytest.mark.asyncio
+async def test_delete_tag_of_other_owner(
+    session: AsyncSession,
+    client: AsyncClient,
+    create_tag: Callable,
+):
+    """Should return 403 and keep the tag."""
+    tag = await create_tag(owner_id=uuid.uuid4())
+
+    response = await client.delete(URL_TAGS + str(tag.id))
+    assert response.status_code == 403
+
+    result = await session.scalars(select(Tag.id).where(Tag.id == tag.id))
+    assert result.all() == [tag.id]
+
 
 @pytest.mark.asyncio
 async def test_delete_missing_tag(client: AsyncClient):
@@ -72,3 +98,77 @@ async def test_delete_missing_tag(client: AsyncClient):
     response = await client.delete(URL_TAGS + str(tag_id))
     assert response.status_code == 404
     assert response.json() == {'detail': f'Tag {tag_id} was not found.'}
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_tags(session: AsyncSession, create_tag: Callable):
+    """Should return the tags in the order of the names, without duplicates."""
+    tag = await create_tag(name='b')
+
+    tags = await get_or_create_tags(session, tag.owner_id, ['c', 'b', 'a', 'c'])
+    assert [x.name for x in tags] == ['c', 'b', 'a']
+    assert tags[1] is tag
+    assert all(x in session for x in tags)
+
+
+@pytest.mark.asyncio
+async def test_get_or_create_tags_outlive_rollback(session: AsyncSession):
+    """
+    New tags should be committed with their events sent even if the transaction using them
+    rolls back. They are left without notes.
+    """
+    broker = EventBroker()
+    owner_id = uuid.uuid4()
+    try:
+        async with broker.subscribe(owner_id) as queue:
+            [tag] = await get_or_create_tags(session, owner_id, ['new'])
+            await session.rollback()
+            event = await asyncio.wait_for(queue.get(), 5)
+    finally:
+        await broker.close()
+
+    assert event == {'entity': 'tag', 'action': 'created', 'id': str(tag.id)}
+    result = await session.execute(select(Tag.name).where(Tag.owner_id == owner_id))
+    assert result.scalars().all() == ['new']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('isolation_level', ['READ COMMITTED', 'REPEATABLE READ'])
+async def test_get_or_create_tags_concurrently(db_engine, isolation_level: str):
+    """
+    Should create each tag once when concurrent transactions create it, without failing any
+    of them. The transactions link the tags, so their snapshots must have them.
+    """
+    owner_id = uuid.uuid4()
+    sm = sessionmaker(db_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def create(names: list[str]) -> dict[str, uuid.UUID]:
+        async with sm() as session:
+            await session.connection(execution_options={'isolation_level': isolation_level})
+            tags = await get_or_create_tags(session, owner_id, names)
+            session.add(
+                Note(
+                    name='note',
+                    content='content',
+                    owner_id=owner_id,
+                    embedding=None,
+                    embedding_source_hash=None,
+                    tags=tags,
+                )
+            )
+            await session.commit()
+            return {x.name: x.id for x in tags}
+
+    names = ['a', 'b', 'c']
+    results = await asyncio.gather(
+        *[create(names if i % 2 else names[::-1]) for i in range(10)],
+        return_exceptions=True,
+    )
+    errors = [x for x in results if isinstance(x, Exception)]
+    assert errors == []
+
+    async with sm() as session:
+        result = await session.execute(select(Tag.name, Tag.id).where(Tag.owner_id == owner_id))
+        name_to_id = dict(result.all())
+    assert sorted(name_to_id) == names
+    assert all(x == name_to_id for x in results)